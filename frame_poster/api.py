@@ -0,0 +1,121 @@
+import io
+
+from PIL import Image
+
+from . import cache, compose, core, printer, probe, store
+
+
+class ProgressPrinter(printer.DummyPrinter):
+    '''
+    A silent printer which reports progress to a callback instead, as
+    callback(seconds_done, seconds_total)
+    '''
+    def __init__(self, callback):
+        self.callback = callback
+
+    def progressf(self, num_blocks=None, block_size=1, total_size=None, *args, **kwargs):
+        self.callback(min(num_blocks * block_size, total_size), total_size)
+
+
+class PosterJob:
+    '''
+    A poster render for embedding frame-poster in another program. Thumbnails
+    are available as a generator with frames(), and the finished poster as a
+    Pillow image with render() or as encoded bytes with render_bytes(), so
+    nothing has to be read back from disk.
+
+    Nothing is printed by default; pass a prntr, or a progress callback which
+    is called as progress(seconds_done, seconds_total).
+    '''
+    def __init__(self, movie_filepath, thumbnail_width=core.THUMBNAIL_SIZE, seconds_increment=core.SECONDS_INCREMENT, frames_per_row=core.FRAMES_PER_ROW, extractor=core.EXTRACTOR, jobs=core.JOBS, scaler=core.SCALER, resample=core.RESAMPLE, compositor=core.COMPOSITOR, frame_store=store.FRAME_STORE, cache_dir=None, cache_size=cache.CACHE_SIZE, keyframe_tolerance=core.KEYFRAME_TOLERANCE, scene_threshold=core.SCENE_THRESHOLD, max_frames=None, row_spacing=None, dedup_threshold=None, compress_level=compose.COMPRESS_LEVEL, encode_jobs=compose.ENCODE_JOBS, prntr=None, progress=None, profiler=None):
+        self.movie_filepath = movie_filepath
+        self.thumbnail_width = thumbnail_width
+        self.seconds_increment = seconds_increment
+        self.frames_per_row = frames_per_row
+        self.extractor = extractor
+        self.jobs = jobs
+        self.scaler = scaler
+        self.resample = resample
+        self.compositor = compositor
+        self.frame_store = frame_store
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.keyframe_tolerance = keyframe_tolerance
+        self.scene_threshold = scene_threshold
+        self.max_frames = max_frames if extractor == 'scene' else None
+        self.row_spacing = row_spacing
+        self.dedup_threshold = dedup_threshold
+        self.compress_level = compress_level
+        self.encode_jobs = encode_jobs
+        self.profiler = profiler
+
+        if prntr is None:
+            prntr = ProgressPrinter(progress) if progress else printer.DummyPrinter()
+        self.prntr = prntr
+
+    @property
+    def metadata(self):
+        return probe.probe_movie(self.movie_filepath)
+
+    def estimate(self):
+        # the poster layout from the movie's metadata, without decoding anything
+        return core.estimate_poster(
+            self.metadata, self.thumbnail_width, self.seconds_increment, self.frames_per_row,
+            self.row_spacing, self.max_frames
+        )
+
+    def frames(self):
+        # yield (seconds, thumbnail) as each frame is extracted
+        return core.extract_thumbnails(
+            self.movie_filepath, self.thumbnail_width, self.seconds_increment, extractor=self.extractor,
+            jobs=self.jobs, scaler=self.scaler, resample=self.resample, cache_dir=self.cache_dir,
+            cache_size=self.cache_size, keyframe_tolerance=self.keyframe_tolerance,
+            scene_threshold=self.scene_threshold, max_frames=self.max_frames, prntr=self.prntr,
+            profiler=self.profiler
+        )
+
+    def canvas(self, frames=None):
+        '''
+        Lay out the poster from frames, an iterable of (seconds, thumbnail)
+        defaulting to frames(), returning a canvas which must be closed
+        '''
+        if frames is None:
+            frames = self.frames()
+
+        return core.compose_canvas(
+            (im for seconds, im in frames), self.frames_per_row, self.thumbnail_width,
+            compositor=self.compositor, row_spacing=self.row_spacing, frame_store=self.frame_store,
+            expected_frames=core.count_frames(self.metadata.duration, self.seconds_increment, self.max_frames),
+            dedup_threshold=self.dedup_threshold, prntr=self.prntr, profiler=self.profiler
+        )
+
+    def render(self, frames=None):
+        # the whole poster as a Pillow image
+        canvas = self.canvas(frames)
+        try:
+            return Image.frombytes('RGB', (canvas.width, canvas.height), canvas.read_rows(0, canvas.height))
+        finally:
+            canvas.close()
+
+    def render_bytes(self, fmt='PNG', frames=None):
+        # the whole poster encoded in a Pillow format such as PNG, JPEG or TIFF, or named by an extension such as jpg
+        fmt = Image.registered_extensions().get('.' + fmt.lower().lstrip('.'), fmt.upper())
+
+        canvas = self.canvas(frames)
+        try:
+            f = io.BytesIO()
+            compose.write_rows(canvas, f, fmt, compress_level=self.compress_level, jobs=self.encode_jobs)
+            return f.getvalue()
+        finally:
+            canvas.close()
+
+    def save(self, output_filename, frames=None):
+        # write the poster to output_filename, returning the filename actually written
+        canvas = self.canvas(frames)
+        try:
+            return core.save_output(
+                lambda filename: compose.save_rows(canvas, filename, compress_level=self.compress_level, jobs=self.encode_jobs),
+                output_filename, self.prntr
+            )
+        finally:
+            canvas.close()
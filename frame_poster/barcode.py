@@ -0,0 +1,143 @@
+import os
+
+import numpy
+
+from . import compose, core, printer, probe
+
+BARCODE_SECONDS = 1.0   # 0 samples every frame
+BARCODE_HEIGHT = 1080
+BARCODE_MODE = 'mean'
+BARCODE_MODES = ('mean', 'dominant')
+
+# frames are shrunk to this many pixels by ffmpeg before being reduced to a colour
+SAMPLE_SIZE = (32, 18)
+
+# number of frames read from ffmpeg and reduced at once
+REDUCE_BATCH = 256
+
+# bits kept per channel when binning pixels to find a frame's dominant colour
+DOMINANT_BITS = 4
+
+
+class BarcodeCanvas:
+    '''
+    One column per sampled colour, repeated down the full height of the
+    barcode. Rows are generated as they're read, so the barcode is never
+    held in memory as an image.
+    '''
+    def __init__(self, colours, height, column_width=1):
+        row = numpy.frombuffer(bytes(colours), dtype=numpy.uint8).reshape(-1, 3)
+        self.row = numpy.repeat(row, column_width, axis=0).tobytes()
+        self.width = len(row) * column_width
+        self.height = height
+
+    def read_rows(self, y, num_rows):
+        return self.row * num_rows
+
+    def close(self):
+        pass
+
+
+def render_barcode(movie_filepath, output_filename, seconds_increment=BARCODE_SECONDS, height=BARCODE_HEIGHT, column_width=1, mode=BARCODE_MODE, prntr=None):
+    '''
+    Reduce frames sampled every seconds_increment (or every frame, for 0) to
+    a single colour each, and write them side by side as a barcode. Only the
+    colours are kept, 3 bytes per sample.
+
+    Returns the filename actually written.
+    '''
+    metadata = probe.probe_movie(movie_filepath)
+
+    if prntr is None:
+        prntr = printer.CliPrinter()
+    prntr.p('Processing {}'.format(os.path.basename(movie_filepath)))
+
+    # progress is counted in samples, each covering this many seconds
+    sample_length = seconds_increment or 1 / (metadata.frame_rate or 25)
+
+    colours = bytearray()
+    prntr.progressf(0, 1, metadata.length)
+
+    for batch in extract_colours(movie_filepath, seconds_increment, mode):
+        colours.extend(batch.tobytes())
+
+        # display a nice progress bar
+        prntr.progressf(len(colours) // 3, sample_length, metadata.length)
+
+    # end progress bar
+    prntr.close()
+
+    if not colours:
+        raise Exception('No frames could be read from {}'.format(movie_filepath))
+
+    canvas = BarcodeCanvas(colours, height, column_width)
+
+    # interesting info
+    prntr.p('Sampled {} frames'.format(len(colours) // 3))
+    prntr.p('Output image is {}x{} pixels, or {:.2f}x{:.2f} cm at 300 dpi'.format(
+        canvas.width, canvas.height, canvas.width / 300 * 2.54, canvas.height / 300 * 2.54
+    ))
+
+    return core.save_output(lambda filename: compose.save_rows(canvas, filename), output_filename, prntr)
+
+
+def extract_colours(movie_filepath, seconds_increment=BARCODE_SECONDS, mode=BARCODE_MODE):
+    '''
+    Yield (n, 3) uint8 arrays of the mean or dominant colour of each sampled
+    frame, in order, a batch at a time. ffmpeg shrinks every frame to
+    SAMPLE_SIZE as it decodes, so only a few hundred bytes per frame cross
+    the pipe.
+    '''
+    reduce_colours = mean_colours if mode == 'mean' else dominant_colours
+
+    # area scaling averages every source pixel into the small frame
+    video_filter = 'scale={}:{}:flags=area'.format(*SAMPLE_SIZE)
+    if seconds_increment:
+        video_filter = 'fps=1/{}:round=up,{}'.format(seconds_increment, video_filter)
+
+    frame_size = SAMPLE_SIZE[0] * SAMPLE_SIZE[1] * 3
+
+    with core.ffmpeg_pipe(
+        ['ffmpeg', '-i', movie_filepath, '-an', '-sn', '-vf', video_filter, '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+    ) as proc:
+        count = 0
+        while True:
+            buf = core.read_frames(proc.stdout, frame_size, REDUCE_BATCH)
+            if not buf:
+                # NOTE end of movie
+                break
+
+            pixels = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(-1, SAMPLE_SIZE[0] * SAMPLE_SIZE[1], 3)
+            yield reduce_colours(pixels)
+            count += len(pixels)
+
+        if count == 0 and proc.wait() != 0:
+            raise Exception('Failed calling ffmpeg!')
+
+
+def mean_colours(pixels):
+    # (frames, pixels, 3) down to the mean colour of each frame
+    return pixels.mean(axis=1).round().astype(numpy.uint8)
+
+
+def dominant_colours(pixels):
+    '''
+    The most common colour in each frame: pixels are binned by their top
+    DOMINANT_BITS per channel, and the mean of the fullest bin is taken, for
+    all frames in a batch at once
+    '''
+    num_frames = len(pixels)
+    num_bins = 1 << (3 * DOMINANT_BITS)
+
+    binned = (pixels >> (8 - DOMINANT_BITS)).astype(numpy.intp)
+    codes = (binned[..., 0] << (2 * DOMINANT_BITS)) | (binned[..., 1] << DOMINANT_BITS) | binned[..., 2]
+
+    # count bins for every frame in one pass, by giving each frame its own range of bins
+    counts = numpy.bincount(
+        (codes + numpy.arange(num_frames)[:, None] * num_bins).ravel(), minlength=num_frames * num_bins
+    ).reshape(num_frames, num_bins)
+
+    in_bin = codes == counts.argmax(axis=1)[:, None]
+    totals = (pixels * in_bin[..., None]).sum(axis=1)
+    return (totals / in_bin.sum(axis=1)[:, None]).round().astype(numpy.uint8)
+
@@ -0,0 +1,194 @@
+import concurrent.futures
+import glob
+import os
+import threading
+import time
+
+from PIL import Image
+
+from . import core, planner, printer, probe
+
+BATCH_WORKERS = 2
+
+MOVIE_EXTENSIONS = ('.avi', '.m2ts', '.m4v', '.mkv', '.mov', '.mp4', '.mpeg', '.mpg', '.ts', '.webm', '.wmv')
+
+
+def collect_movies(source):
+    '''
+    Return a list of (movie_filepath, output_filename) from a directory, a
+    glob pattern or a manifest file. A manifest has one movie per line,
+    optionally followed by a tab and its output filename; blank lines and
+    lines starting with # are skipped. output_filename is None where it's
+    left to the --output-name template.
+    '''
+    if os.path.isdir(source):
+        return [
+            (os.path.join(dirpath, name), None)
+            for dirpath, _, filenames in sorted(os.walk(source))
+            for name in sorted(filenames)
+            if os.path.splitext(name)[1].lower() in MOVIE_EXTENSIONS
+        ]
+
+    if os.path.isfile(source):
+        movies = []
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                movie_filepath, _, output_filename = line.partition('\t')
+
+                # relative paths in a manifest are relative to the manifest
+                movie_filepath = os.path.join(os.path.dirname(source), movie_filepath.strip())
+                movies.append((movie_filepath, output_filename.strip() or None))
+        return movies
+
+    return [(movie_filepath, None) for movie_filepath in sorted(glob.glob(source)) if os.path.isfile(movie_filepath)]
+
+
+def output_filename_for(movie_filepath, template):
+    # {name} is the movie filename without extension; without it, name the output after the movie
+    if '{name}' not in template:
+        template = os.path.join(os.path.dirname(template), '{name}' + os.path.splitext(template)[1])
+
+    return template.format(name=os.path.splitext(os.path.basename(movie_filepath))[0])
+
+
+def run_batch(movies, output_template, options, workers=BATCH_WORKERS, prntr=None, max_memory=None):
+    '''
+    Render a poster for every movie over a shared pool of workers. options
+    are passed through to core.doit. With max_memory, each worker gets an
+    equal share, and each movie is planned to fit in it, with the plan
+    printed as the movie starts. A failure in one
+    movie is reported and doesn't stop the others. With options['estimate'],
+    each poster is only estimated.
+
+    Returns a list of (movie_filepath, output_filename, seconds, error,
+    estimate), where estimate is the estimate_poster() dict, or None when
+    the poster was rendered.
+    '''
+    if prntr is None:
+        prntr = printer.CliPrinter()
+
+    estimate = options.get('estimate', False)
+
+    jobs = []
+    written = {}
+    for movie_filepath, output_filename in movies:
+        output_filename = output_filename or output_filename_for(movie_filepath, output_template)
+
+        # check up front, as a bad suffix would otherwise fall back to the same output file for every movie
+        ext = os.path.splitext(output_filename)[1].lower()
+        if ext != '.dzi' and ext not in Image.registered_extensions():
+            raise Exception('Invalid file suffix on output file {}'.format(output_filename))
+
+        # movies of the same name in different directories would overwrite each other's posters
+        other = written.setdefault(os.path.abspath(output_filename), movie_filepath)
+        if other != movie_filepath:
+            raise Exception('{} and {} would both be written to {}'.format(other, movie_filepath, output_filename))
+
+        jobs.append((movie_filepath, output_filename))
+
+    if not estimate:
+        # make the output directories now, rather than fail each movie after it's decoded
+        for output_dir in sorted(set(os.path.dirname(filename) for filename in written)):
+            os.makedirs(output_dir, exist_ok=True)
+
+    if max_memory:
+        # workers are threads in this process, so the interpreter is only counted once
+        worker_memory = (max_memory - planner.PYTHON_MEMORY) // workers + planner.PYTHON_MEMORY
+        plan_lock = threading.Lock()
+
+    def render(job):
+        movie_filepath, output_filename = job
+        start = time.time()
+
+        # reported as the absolute path core.save_output writes to, whether the movie is rendered, estimated or fails
+        output_filename = os.path.abspath(output_filename)
+
+        try:
+            movie_options = options
+            if max_memory and not estimate:
+                plan = planner.plan_render(
+                    probe.probe_movie(movie_filepath), [(options['thumbnail_width'], output_filename)],
+                    options['seconds_increment'], options['frames_per_row'], worker_memory,
+                    extractor=options['extractor'], jobs=options['jobs'], compositor=options['compositor'],
+                    frame_store=options['frame_store'], encode_jobs=options['encode_jobs'],
+                    row_spacing=options['row_spacing'], max_frames=options['max_frames']
+                )
+                movie_options = dict(options, **plan.options())
+
+                # held while printing, so plans of movies planned at once don't interleave
+                with plan_lock:
+                    prntr.p('Plan for {}'.format(os.path.basename(movie_filepath)))
+                    planner.print_plan(plan, prntr)
+
+            # each movie runs silently; progress is reported per movie below
+            result = core.doit(
+                movie_filepath, output_filename=output_filename, prntr=printer.DummyPrinter(), **movie_options
+            )
+            if estimate:
+                return movie_filepath, output_filename, time.time() - start, None, result
+            return movie_filepath, result, time.time() - start, None, None
+        except Exception as e:
+            return movie_filepath, output_filename, time.time() - start, e, None
+
+    prntr.p('{} {} movies with {} workers'.format('Estimating' if estimate else 'Rendering', len(jobs), workers))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render, job) for job in jobs]
+
+        # report each movie as it finishes
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            movie_filepath, output_filename, _, error, _ = future.result()
+
+            if error is None:
+                prntr.p('[{}/{}] {} {} {}'.format(
+                    i + 1, len(jobs), os.path.basename(movie_filepath),
+                    'estimated for' if estimate else 'written to', output_filename
+                ), success=True)
+            else:
+                prntr.p('[{}/{}] {} failed: {}'.format(
+                    i + 1, len(jobs), os.path.basename(movie_filepath), error
+                ), success=False)
+
+    # results in the order the movies were given
+    return [future.result() for future in futures]
+
+
+def print_summary(results, prntr):
+    # estimates are summarised by the poster they describe, in place of the time taken
+    estimated = any(estimate for _, _, _, _, estimate in results)
+    if estimated:
+        table = [['Movie', 'Output', 'Frames', 'Size (px)', 'File (MB)', 'Status']]
+    else:
+        table = [['Movie', 'Output', 'Time', 'Status']]
+
+    for movie_filepath, output_filename, seconds, error, estimate in results:
+        row = [os.path.basename(movie_filepath), output_filename]
+
+        if not estimated:
+            row.append('{:.1f}s'.format(seconds))
+        elif estimate is None:
+            row += ['', '', '']
+        else:
+            num_bytes = estimated_file_size(estimate, output_filename)
+            row += [
+                estimate['num_frames'],
+                '{}x{}'.format(*estimate['output_size']),
+                '' if num_bytes is None else '{:.1f}'.format(num_bytes / 1024 / 1024),
+            ]
+
+        row.append('OK' if error is None else 'FAILED')
+        table.append(row)
+    prntr.p(table, tabular=True)
+
+
+def estimated_file_size(estimate, output_filename):
+    # the estimated bytes for the format output_filename is written in, or None for formats not estimated
+    fmt = Image.registered_extensions().get(os.path.splitext(output_filename)[1].lower())
+    for estimate_fmt, num_bytes, _ in estimate['file_sizes']:
+        if estimate_fmt == fmt:
+            return num_bytes
+    return None
@@ -0,0 +1,375 @@
+'''
+Benchmarks for the frame-poster pipeline, run against synthetic movies made
+locally with ffmpeg's lavfi sources, so nothing needs downloading.
+
+    python -m frame_poster.benchmark [--quick] [--output results.json]
+    python -m frame_poster.benchmark --compare before.json [after.json]
+
+Each case runs in its own Python process so peak RSS is measured per case.
+Fixtures for the compose and encode cases are made beforehand in the parent
+process, so their peak RSS is only that of the stage being measured.
+Results are written as JSON, for comparing one commit against another.
+'''
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from . import __version__, compose, core, printer, probe
+
+BENCHMARK_DIR = os.path.join(tempfile.gettempdir(), 'frame-poster-benchmark')
+
+# synthetic movies as (width, height, seconds, codec)
+MOVIES = [
+    (640, 360, 120, 'mpeg4'),
+    (1280, 720, 300, 'libx264'),
+    (1920, 1080, 600, 'libx264'),
+    (1920, 1080, 300, 'libvpx-vp9'),
+]
+QUICK_MOVIES = MOVIES[:1]
+
+FRAME_RATE = 24
+
+# sampling used by every case, so cases over the same movie are comparable
+SECONDS_INCREMENT = 10
+
+# changes smaller than this fraction are reported as noise by --compare
+COMPARE_TOLERANCE = 0.05
+
+
+def movie_filename(benchmark_dir, width, height, seconds, codec):
+    ext = '.webm' if codec.startswith('libvpx') else '.mp4'
+    return os.path.join(benchmark_dir, 'testsrc-{}x{}-{}s-{}{}'.format(width, height, seconds, codec, ext))
+
+
+def make_movie(filename, width, height, seconds, codec):
+    '''
+    Render a synthetic movie with a moving test pattern and a keyframe every
+    two seconds, unless it was already made by an earlier run
+    '''
+    if os.path.exists(filename):
+        return filename
+
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    args = [
+        'ffmpeg', '-v', 'error', '-y', '-f', 'lavfi',
+        '-i', 'testsrc2=size={}x{}:rate={}:duration={}'.format(width, height, FRAME_RATE, seconds),
+        '-c:v', codec, '-g', str(FRAME_RATE * 2), '-pix_fmt', 'yuv420p',
+    ]
+    if codec == 'libx264':
+        args += ['-preset', 'veryfast']
+    elif codec.startswith('libvpx'):
+        args += ['-deadline', 'realtime', '-cpu-used', '8', '-b:v', '2M']
+
+    # write alongside and rename, so an interrupted run never leaves a truncated movie
+    tmp_filename = '{}.tmp{}'.format(*os.path.splitext(filename))
+    subprocess.check_call(args + [tmp_filename])
+    os.rename(tmp_filename, filename)
+    return filename
+
+
+def fixture_filenames(movie_filepath):
+    # a thumbnail for the compose cases, and a poster laid out as raw RGB rows for the encode cases
+    base = os.path.splitext(movie_filepath)[0]
+    return base + '-thumbnail.png', base + '-poster-{}s.rgb'.format(SECONDS_INCREMENT)
+
+
+def make_fixtures(movie_filepath):
+    '''
+    Make the thumbnail and poster the compose and encode cases start from,
+    unless they were already made by an earlier run
+    '''
+    thumbnail_filename, poster_filename = fixture_filenames(movie_filepath)
+    if os.path.exists(thumbnail_filename) and os.path.exists(poster_filename):
+        return
+
+    metadata = probe.probe_movie(movie_filepath)
+    size = core.thumbnail_size(metadata.frame_size, core.THUMBNAIL_SIZE)
+
+    with core.make_temp_directory() as tmpdir:
+        # the poster is made of the movie's own frames, as a repeated thumbnail would flatter the encoders
+        canvas = compose.RowSpool(core.THUMBNAIL_SIZE * core.FRAMES_PER_ROW, tmpdir)
+        rows = compose.RowCompositor(canvas, core.FRAMES_PER_ROW, core.THUMBNAIL_SIZE)
+        thumbnail = None
+        for _, im in core.extract_frames_pipe(movie_filepath, tmpdir, SECONDS_INCREMENT, size=size):
+            thumbnail = thumbnail or im.copy()
+            rows.add(im)
+        rows.close()
+
+        # write alongside and rename, so an interrupted run never leaves a truncated fixture
+        thumbnail.save(thumbnail_filename + '.tmp', format='PNG')
+        os.rename(thumbnail_filename + '.tmp', thumbnail_filename)
+
+        canvas.f.seek(0)
+        with open(poster_filename + '.tmp', 'wb') as f:
+            shutil.copyfileobj(canvas.f, f)
+        canvas.close()
+        os.rename(poster_filename + '.tmp', poster_filename)
+
+
+class PosterFile:
+    '''
+    A poster laid out ahead of time as raw RGB rows on disk, read back a band
+    at a time by the encoders
+    '''
+    def __init__(self, filename, width):
+        self.width = width
+        self.height = os.path.getsize(filename) // (width * 3)
+        self.f = open(filename, 'rb')
+
+    def read_rows(self, y, num_rows):
+        self.f.seek(y * self.width * 3)
+        return self.f.read(num_rows * self.width * 3)
+
+    def close(self):
+        self.f.close()
+
+
+def available_codecs():
+    output = subprocess.check_output(['ffmpeg', '-hide_banner', '-encoders'], stderr=subprocess.DEVNULL)
+    return set(line.split()[1] for line in output.decode('utf8').splitlines() if line.startswith(' V'))
+
+
+def make_cases(movie_filepath):
+    '''
+    The cases run against each movie: the full pipeline with default options,
+    then each stage on its own
+    '''
+    cases = [{'stage': 'doit', 'movie': movie_filepath}]
+    cases.append({'stage': 'probe', 'movie': movie_filepath})
+
+    for extractor in sorted(core.EXTRACTORS):
+        cases.append({'stage': 'extract', 'movie': movie_filepath, 'extractor': extractor})
+
+    for compositor in ('stream', 'mmap', 'memory'):
+        cases.append({'stage': 'compose', 'movie': movie_filepath, 'compositor': compositor})
+
+    for fmt in ('bmp', 'png', 'tif', 'jpg'):
+        cases.append({'stage': 'encode', 'movie': movie_filepath, 'format': fmt})
+
+    return cases
+
+
+def case_name(case):
+    option = case.get('extractor') or case.get('compositor') or case.get('format')
+    return '{}:{}{}'.format(
+        os.path.splitext(os.path.basename(case['movie']))[0], case['stage'], '-' + option if option else ''
+    )
+
+
+def run_case(case):
+    '''
+    Run one case in this process, returning a dict of frames, wall time and
+    peak RSS for this process and for the ffmpeg processes it ran
+    '''
+    movie_filepath = case['movie']
+    metadata = probe.probe_movie(movie_filepath)
+    size = core.thumbnail_size(metadata.frame_size, core.THUMBNAIL_SIZE)
+    num_frames = core.count_frames(metadata.duration, SECONDS_INCREMENT)
+
+    # forget the metadata, so cases which probe the movie themselves are timed doing so
+    probe._probe_cache.clear()
+
+    thumbnail_filename, poster_filename = fixture_filenames(movie_filepath)
+
+    with core.make_temp_directory() as tmpdir:
+        if case['stage'] == 'compose':
+            # the same thumbnail over and over; compositing doesn't depend on content
+            thumbnail = Image.open(thumbnail_filename)
+            thumbnail.load()
+
+        if case['stage'] == 'encode':
+            # the poster was laid out by make_fixtures, so only the encoder is timed
+            canvas = PosterFile(poster_filename, core.THUMBNAIL_SIZE * core.FRAMES_PER_ROW)
+
+        start = time.time()
+
+        if case['stage'] == 'doit':
+            core.doit(
+                movie_filepath, core.THUMBNAIL_SIZE, SECONDS_INCREMENT, core.FRAMES_PER_ROW,
+                os.path.join(tmpdir, 'poster.bmp'), prntr=printer.DummyPrinter()
+            )
+
+        elif case['stage'] == 'probe':
+            # skip the in-process cache, which would make this free
+            probe._run_probe(movie_filepath)
+            num_frames = 0
+
+        elif case['stage'] == 'extract':
+            frames = core.EXTRACTORS[case['extractor']](movie_filepath, tmpdir, SECONDS_INCREMENT, size=size)
+            num_frames = sum(1 for _ in frames)
+
+        elif case['stage'] == 'compose':
+            core.compose_poster(
+                itertools.repeat(thumbnail, num_frames), core.FRAMES_PER_ROW, core.THUMBNAIL_SIZE,
+                os.path.join(tmpdir, 'poster.bmp'), compositor=case['compositor'], prntr=printer.DummyPrinter()
+            )
+
+        elif case['stage'] == 'encode':
+            compose.save_rows(canvas, os.path.join(tmpdir, 'poster.{}'.format(case['format'])))
+            canvas.close()
+
+        seconds = time.time() - start
+
+    return dict(
+        case,
+        name=case_name(case),
+        frames=num_frames,
+        seconds=round(seconds, 4),
+        frames_per_second=round(num_frames / seconds, 2) if num_frames else None,
+        # kilobytes on Linux
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        ffmpeg_peak_rss_kb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def run_suite(movies=MOVIES, benchmark_dir=BENCHMARK_DIR, repeat=1, prntr=None):
+    '''
+    Make the synthetic movies and run every case against them, each in a
+    fresh interpreter. With repeat, the fastest run of each case is kept.
+    '''
+    if prntr is None:
+        prntr = printer.CliPrinter()
+
+    codecs = available_codecs()
+    results = []
+
+    for width, height, seconds, codec in movies:
+        if codec not in codecs:
+            prntr.p('Skipping {}x{} {}: this ffmpeg has no {} encoder'.format(width, height, codec, codec), success=False)
+            continue
+
+        filename = movie_filename(benchmark_dir, width, height, seconds, codec)
+        if not os.path.exists(filename):
+            prntr.p('Making {}'.format(os.path.basename(filename)))
+        make_movie(filename, width, height, seconds, codec)
+        make_fixtures(filename)
+
+        for case in make_cases(filename):
+            runs = [_run_case_process(case) for _ in range(repeat)]
+            result = min(runs, key=lambda run: run['seconds'])
+            results.append(result)
+
+            prntr.p('{} {:.2f}s {}'.format(
+                result['name'], result['seconds'],
+                '{} fps'.format(result['frames_per_second']) if result['frames_per_second'] else ''
+            ))
+
+    return {
+        'version': __version__,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'ffmpeg': _ffmpeg_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+
+
+def compare(before, after, prntr, tolerance=COMPARE_TOLERANCE):
+    # table of each case's time and peak RSS, before and after
+    table = [['Case', 'Before', 'After', 'Change', 'RSS before', 'RSS after']]
+
+    previous = dict((result['name'], result) for result in before['results'])
+
+    for result in after['results']:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+
+        change = (result['seconds'] - old['seconds']) / old['seconds'] if old['seconds'] else 0
+        table.append([
+            result['name'],
+            '{:.2f}s'.format(old['seconds']),
+            '{:.2f}s'.format(result['seconds']),
+            '{:+.0%}'.format(change) if abs(change) >= tolerance else '~',
+            '{}MB'.format(old['peak_rss_kb'] // 1024),
+            '{}MB'.format(result['peak_rss_kb'] // 1024),
+        ])
+
+    prntr.p('Comparing {} with {}'.format(before.get('commit') or 'before', after.get('commit') or 'after'))
+    prntr.p(table, tabular=True)
+
+
+def _run_case_process(case):
+    # the result is the last line the child writes
+    output = subprocess.check_output([sys.executable, '-m', 'frame_poster.benchmark', '--run-case', json.dumps(case)])
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _ffmpeg_version():
+    output = subprocess.check_output(['ffmpeg', '-version']).decode('utf8')
+    return output.splitlines()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='frame-poster benchmarks')
+    parser.add_argument(
+        '-o', '--output',
+        help='Write results as JSON to this file'
+    )
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='Only benchmark the smallest movie'
+    )
+    parser.add_argument(
+        '--repeat', default=1, type=int,
+        help='Run each case this many times and keep the fastest (default is 1)'
+    )
+    parser.add_argument(
+        '--benchmark-dir', default=BENCHMARK_DIR,
+        help='Where the synthetic movies are kept between runs (default is {})'.format(BENCHMARK_DIR)
+    )
+    parser.add_argument(
+        '--compare', nargs='+', metavar='RESULTS',
+        help='Compare earlier results with a second results file, or with a fresh run'
+    )
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return
+
+    prntr = printer.CliPrinter()
+
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes one or two results files')
+
+    if args.compare and len(args.compare) == 2:
+        before, after = [json.load(open(filename)) for filename in args.compare]
+    else:
+        after = run_suite(QUICK_MOVIES if args.quick else MOVIES, args.benchmark_dir, args.repeat, prntr)
+        before = json.load(open(args.compare[0])) if args.compare else None
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(after, f, indent=2)
+            prntr.p('Results written to {}'.format(args.output))
+
+    if before is not None:
+        compare(before, after, prntr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import hashlib
+import os
+
+from PIL import Image
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'frame-poster')
+CACHE_SIZE = 1024    # MB
+
+# eviction goes below the limit to this fraction of it, so the cache is walked once per tenth of its size written
+CACHE_LOW_WATER = 0.9
+
+# bytes read from the start of a movie to identify it
+HEADER_SIZE = 64 * 1024
+
+
+def movie_key(movie_filepath):
+    # identify a movie by size, mtime and a hash of its header, without reading the whole file
+    stat = os.stat(movie_filepath)
+
+    with open(movie_filepath, 'rb') as f:
+        header = hashlib.sha1(f.read(HEADER_SIZE)).hexdigest()
+
+    return hashlib.sha1('{}:{}:{}'.format(stat.st_size, stat.st_mtime, header).encode('utf8')).hexdigest()
+
+
+class FrameCache:
+    '''
+    Thumbnails on disk, keyed by movie identity, timestamp and thumbnail
+    variant. The least recently used thumbnails are evicted once the cache
+    grows beyond max_size bytes. Other runs may share the directory, so
+    thumbnails can disappear at any time.
+    '''
+    def __init__(self, cache_dir=CACHE_DIR, max_size=CACHE_SIZE * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        # total size is only calculated on the first write
+        self.size = None
+
+        self.hits = self.misses = 0
+
+    def get(self, movie_key, variant, seconds):
+        filename = self._filename(movie_key, variant, seconds)
+
+        try:
+            im = Image.open(filename)
+            im.load()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        # mark as recently used, unless it was evicted meanwhile
+        try:
+            os.utime(filename, None)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return im
+
+    def put(self, movie_key, variant, seconds, im):
+        filename = self._filename(movie_key, variant, seconds)
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        # write alongside and rename, so a killed run never leaves a truncated thumbnail
+        im.save(filename + '.tmp', format='PNG', compress_level=1)
+        size = os.path.getsize(filename + '.tmp')
+        os.rename(filename + '.tmp', filename)
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self._entries())
+        else:
+            self.size += size
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        # remove least recently used thumbnails until the cache is down to its low water mark
+        entries = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+
+        for _, size, filename in entries:
+            if self.size <= self.max_size * CACHE_LOW_WATER:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                # already evicted by another run
+                pass
+            self.size -= size
+
+    def _entries(self):
+        # (mtime, size, filename) for every cached thumbnail
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                if name.endswith('.png'):
+                    try:
+                        stat = os.stat(os.path.join(dirpath, name))
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, os.path.join(dirpath, name)
+
+    def _filename(self, movie_key, variant, seconds):
+        return os.path.join(self.cache_dir, movie_key[:2], movie_key, '{}-{}.png'.format(variant, seconds))
+
+
+def cached_frames(cache, movie_key, variant, seconds_increment, extract, start=0, duration=None):
+    '''
+    Yield (seconds, thumbnail) from the cache, beginning at start, until the
+    first timestamp which is missing. Then call extract(start) to decode the
+    rest of the movie from there, caching each new thumbnail as it arrives.
+    With the movie's duration, a movie cached to the end isn't decoded at all.
+    '''
+    seconds = start
+
+    while duration is None or seconds < duration:
+        im = cache.get(movie_key, variant, seconds)
+        if im is None:
+            break
+
+        yield seconds, im
+        seconds += seconds_increment
+    else:
+        return
+
+    for seconds, im in extract(seconds):
+        cache.put(movie_key, variant, seconds, im)
+        yield seconds, im
@@ -1,9 +1,16 @@
 import argparse
+import contextlib
 import os
 import sys
 
-from . import __version__
-from .core import doit, THUMBNAIL_SIZE, SECONDS_INCREMENT, FRAMES_PER_ROW
+from PIL import Image
+
+from . import __version__, barcode, batch, dedup, planner, printer, probe, profiling
+from .cache import CACHE_DIR, CACHE_SIZE
+from .compose import COMPRESS_LEVEL, ENCODE_JOBS
+from .store import FRAME_STORE, FRAME_STORE_CODECS
+from .workdir import WorkDirException
+from .core import doit, compose_from_work_dir, THUMBNAIL_SIZE, SECONDS_INCREMENT, FRAMES_PER_ROW, EXTRACTOR, EXTRACTORS, JOBS, KEYFRAME_TOLERANCE, SCENE_THRESHOLD, SCALER, RESAMPLE, RESAMPLE_FILTERS, COMPOSITOR, OUTPUT_FILENAME
 
 class AppException(Exception):
     pass
@@ -36,18 +43,46 @@ def parse_command_line():
     )
 
     parser.add_argument(
-        'movie_file',
-        help='The movie file to process into a poster'
+        'movie_file', nargs='?',
+        help='The movie file to process into a poster; with --batch, a directory, glob or manifest of movies; '
+             'not needed with --compose-only, as the work dir records its movie'
+    )
+    parser.add_argument(
+        '-B', '--batch', action='store_true',
+        help='Render a poster for every movie in a directory, glob or manifest file (one movie per line, '
+             'optionally followed by a tab and output filename)'
+    )
+    parser.add_argument(
+        '--batch-workers', default=batch.BATCH_WORKERS, type=int,
+        help='The number of movies rendered at once with --batch (default is {})'.format(batch.BATCH_WORKERS)
     )
 
     parser.add_argument(
         '-E', '--estimate', action='store_true',
         help="Don't create a poster; just estimate its final size"
     )
+    parser.add_argument(
+        '--barcode', nargs='?', const=barcode.BARCODE_MODE, choices=barcode.BARCODE_MODES,
+        help='Render a colour barcode instead of a poster: one column per sampled frame, in its mean or dominant '
+             'colour (default is {})'.format(barcode.BARCODE_MODE)
+    )
+    parser.add_argument(
+        '--barcode-seconds', default=barcode.BARCODE_SECONDS, type=float,
+        help='The number of seconds between each barcode sample, or 0 for every frame (default is {})'.format(barcode.BARCODE_SECONDS)
+    )
+    parser.add_argument(
+        '--barcode-height', default=barcode.BARCODE_HEIGHT, type=int,
+        help='The height of the barcode image (default is {}px)'.format(barcode.BARCODE_HEIGHT)
+    )
     parser.add_argument(
         '-w', '--thumbnail-width', default=THUMBNAIL_SIZE, type=int,
         help='The width of each thumbnail in the output image (default is {}px)'.format(THUMBNAIL_SIZE)
     )
+    parser.add_argument(
+        '--sizes', nargs='+', type=parse_size, metavar='WIDTH[:FILENAME]',
+        help='Render a poster for each thumbnail width from a single extraction, such as 240:print.png 120:web.jpg; '
+             'without a FILENAME, the width is added to --output-name'
+    )
     parser.add_argument(
         '-s', '--seconds-between-frames', default=SECONDS_INCREMENT, type=int,
         help='The number of seconds between each frame capture (default is {})'.format(SECONDS_INCREMENT)
@@ -57,24 +92,304 @@ def parse_command_line():
         help='The number of frames per row in the output image (default is {})'.format(FRAMES_PER_ROW)
     )
     parser.add_argument(
-        '-O', '--output-name', default='output.bmp',
-        help='The output filename (default is output.bmp)'
+        '--compress-level', default=COMPRESS_LEVEL, type=int,
+        help='The deflate level for PNG and TIFF output, where 0 is uncompressed (default is {})'.format(COMPRESS_LEVEL)
+    )
+    parser.add_argument(
+        '--encode-jobs', default=ENCODE_JOBS, type=int,
+        help='The number of threads compressing PNG and TIFF output (default is {})'.format(ENCODE_JOBS)
+    )
+    parser.add_argument(
+        '--row-spacing', type=int,
+        help='The height in pixels of the black spacing between rows (default is a third of the thumbnail height)'
+    )
+    parser.add_argument(
+        '--dedup', nargs='?', const=dedup.DEDUP_THRESHOLD, type=int, metavar='THRESHOLD',
+        help='Leave out thumbnails which look almost the same as the one before, such as black frames and static '
+             'shots; THRESHOLD is how many bits of a 64-bit perceptual hash may differ (default is {})'.format(dedup.DEDUP_THRESHOLD)
+    )
+    parser.add_argument(
+        '-O', '--output-name', default=OUTPUT_FILENAME,
+        help='The output filename, whose suffix chooses the format, or .dzi for a Deep Zoom tile pyramid (default is {}); with --batch, a template where {{name}} is replaced '
+             'by the movie name, which defaults to {{name}} plus the suffix given here'.format(OUTPUT_FILENAME)
+    )
+    parser.add_argument(
+        '-x', '--extractor', default=EXTRACTOR, choices=sorted(EXTRACTORS),
+        help='How frames are pulled from the movie; "pipe" streams raw frames from a single decode of the whole movie, which is faster when sampling more often than the movie has keyframes, "seek" runs ffmpeg per frame, "keyframe" decodes only the keyframes nearest each timestamp, "scene" picks frames at scene changes (default is {})'.format(EXTRACTOR)
+    )
+    parser.add_argument(
+        '--keyframe-tolerance', default=KEYFRAME_TOLERANCE, type=float,
+        help='How far in seconds a frame may be moved to land on a keyframe with --extractor keyframe; frames '
+             'further from a keyframe are seeked to exactly (default is {})'.format(KEYFRAME_TOLERANCE)
+    )
+    parser.add_argument(
+        '--scene-threshold', default=SCENE_THRESHOLD, type=float,
+        help='How different a frame must be from the one before to count as a scene change with --extractor scene, '
+             'from 0 to 1 (default is {})'.format(SCENE_THRESHOLD)
+    )
+    parser.add_argument(
+        '--max-frames', type=int,
+        help='The most frames kept with --extractor scene; the biggest scene changes are kept (default is as many '
+             'frames as --seconds-between-frames would give)'
+    )
+    parser.add_argument(
+        '-j', '--jobs', default=JOBS, type=int,
+        help='The number of ffmpeg workers extracting frames in parallel (default is {})'.format(JOBS)
+    )
+    parser.add_argument(
+        '--scaler', default=SCALER, choices=('ffmpeg', 'pillow'),
+        help='Scale frames down to thumbnails in ffmpeg as they are decoded, or afterwards in Pillow (default is {})'.format(SCALER)
+    )
+    parser.add_argument(
+        '--resample', default=RESAMPLE, choices=sorted(RESAMPLE_FILTERS),
+        help='The resample filter used when scaling frames to thumbnails (default is {})'.format(RESAMPLE)
+    )
+    parser.add_argument(
+        '--compositor', default=COMPOSITOR, choices=('stream', 'mmap', 'memory'),
+        help='Paste each row into the poster as soon as it is complete, paste frames into a memory-mapped canvas on disk, or hold every thumbnail in memory until the end (default is {})'.format(COMPOSITOR)
+    )
+    parser.add_argument(
+        '--frame-store', default=FRAME_STORE, choices=FRAME_STORE_CODECS,
+        help='How thumbnails are held with --compositor memory: packed "raw", losslessly compressed with "deflate", '
+             'or as "jpeg", which is smallest but lossy (default is {})'.format(FRAME_STORE)
+    )
+    parser.add_argument(
+        '--max-memory', type=int, metavar='MB',
+        help='Keep the render within this much memory in MB, choosing --jobs, --encode-jobs, --compositor and where '
+             'temp files go to fit, from the movie metadata before anything is decoded; with --batch, shared between '
+             'the workers'
+    )
+    parser.add_argument(
+        '--cache-dir', default=CACHE_DIR,
+        help='Where thumbnails are cached between runs (default is {})'.format(CACHE_DIR)
+    )
+    parser.add_argument(
+        '--cache-size', default=CACHE_SIZE, type=int,
+        help='The maximum size of the thumbnail cache in MB (default is {})'.format(CACHE_SIZE)
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="Don't read or write the thumbnail cache"
+    )
+    parser.add_argument(
+        '--work-dir',
+        help='Keep extracted thumbnails and progress in this directory, so an interrupted render can be resumed'
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Carry on from the last frame saved in --work-dir, instead of starting over'
+    )
+    parser.add_argument(
+        '--extract-only', action='store_true',
+        help="Extract frames into --work-dir and stop, without creating a poster"
+    )
+    parser.add_argument(
+        '--compose-only', action='store_true',
+        help='Lay out a poster from the frames already extracted into --work-dir, without decoding the movie; '
+             'only the layout options apply'
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print how long each stage of the pipeline took'
+    )
+    parser.add_argument(
+        '--profile-json', metavar='FILE',
+        help='Write stage timings and counters to FILE as JSON'
+    )
+    parser.add_argument(
+        '--cprofile', metavar='FILE',
+        help='Run under cProfile, writing stats for pstats or snakeviz to FILE; the --jobs and --batch worker '
+             'threads are profiled too, and merged into the same stats'
     )
 
     args = parser.parse_args()
 
-    if not os.path.isfile(args.movie_file):
+    if args.movie_file is None and not args.compose_only:
+        parser.error('the following arguments are required: movie_file')
+
+    if args.resume and not args.work_dir:
+        parser.error('--resume needs a --work-dir')
+
+    if (args.extract_only or args.compose_only) and not args.work_dir:
+        parser.error('--extract-only and --compose-only need a --work-dir')
+
+    if args.extract_only and args.compose_only:
+        parser.error('--extract-only and --compose-only cannot be used together')
+
+    if args.barcode and (args.batch or args.work_dir or args.estimate):
+        parser.error('--barcode cannot be used with --batch, --work-dir or --estimate')
+
+    if args.barcode_seconds < 0 or args.barcode_height < 1:
+        parser.error('--barcode-seconds cannot be negative, and --barcode-height must be at least 1')
+
+    if args.batch and args.work_dir:
+        parser.error('--work-dir applies to a single movie, and cannot be used with --batch')
+
+    if args.batch:
+        args.movies = batch.collect_movies(args.movie_file)
+        if not args.movies:
+            parser.error('No movies found in {}'.format(args.movie_file))
+
+        if args.batch_workers < 1:
+            parser.error('--batch-workers must be at least 1')
+
+    elif not args.compose_only and not os.path.isfile(args.movie_file):
         parser.error('File {} does not exist'.format(args.movie_file))
 
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    if not 0 <= args.compress_level <= 9:
+        parser.error('--compress-level must be between 0 and 9')
+
+    if args.encode_jobs < 1:
+        parser.error('--encode-jobs must be at least 1')
+
+    if args.max_frames is not None and args.max_frames < 1:
+        parser.error('--max-frames must be at least 1')
+
+    if args.extractor == 'scene' and args.work_dir:
+        parser.error('--work-dir cannot be used with --extractor scene')
+
+    if args.dedup is not None and not 0 <= args.dedup <= 64:
+        parser.error('--dedup threshold must be between 0 and 64')
+
+    if args.row_spacing is not None and args.row_spacing < 0:
+        parser.error('--row-spacing cannot be negative')
+
+    if args.max_memory is not None:
+        if args.max_memory < 1:
+            parser.error('--max-memory must be at least 1')
+
+        if args.barcode or args.compose_only:
+            parser.error('--max-memory plans extraction, and cannot be used with --barcode or --compose-only')
+
+    if args.sizes:
+        if args.batch or args.barcode or args.extract_only:
+            parser.error('--sizes cannot be used with --batch, --barcode or --extract-only')
+
+        # unnamed sizes are written alongside --output-name, as output-120.png
+        base, ext = os.path.splitext(args.output_name)
+        args.sizes = [(width, filename or '{}-{}{}'.format(base, width, ext)) for width, filename in args.sizes]
+
+        if len(set(filename for _, filename in args.sizes)) < len(args.sizes):
+            parser.error('--sizes must each be written to a different file')
+
+        # a bad suffix would otherwise fall back to the same output file for every size
+        for _, filename in args.sizes:
+            ext = os.path.splitext(filename)[1].lower()
+            if ext != '.dzi' and ext not in Image.registered_extensions():
+                parser.error('Invalid file suffix on --sizes output file {}'.format(filename))
+
     return args
 
 
+def parse_size(value):
+    # WIDTH or WIDTH:FILENAME for --sizes
+    width, _, filename = value.partition(':')
+    try:
+        width = int(width)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not WIDTH or WIDTH:FILENAME'.format(value))
+
+    if width < 1:
+        raise argparse.ArgumentTypeError('{} is not a width of at least 1px'.format(value))
+
+    return width, filename or None
+
+
 def main(args):
-    doit(
-        args.movie_file,
-        args.thumbnail_width,
-        args.seconds_between_frames,
-        args.frames_per_row,
-        args.output_name,
+    options = dict(
+        thumbnail_width=args.thumbnail_width,
+        seconds_increment=args.seconds_between_frames,
+        frames_per_row=args.frames_per_row,
         estimate=args.estimate,
+        extractor=args.extractor,
+        jobs=args.jobs,
+        scaler=args.scaler,
+        resample=args.resample,
+        compositor=args.compositor,
+        frame_store=args.frame_store,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_size=args.cache_size,
+        keyframe_tolerance=args.keyframe_tolerance,
+        scene_threshold=args.scene_threshold,
+        max_frames=args.max_frames,
+        dedup_threshold=args.dedup,
+        row_spacing=args.row_spacing,
+        compress_level=args.compress_level,
+        encode_jobs=args.encode_jobs,
     )
+
+    # stage timings are collected across every movie in a batch
+    profiler = None
+    if args.profile or args.profile_json:
+        profiler = profiling.Profiler()
+    options['profiler'] = profiler
+
+    try:
+        with profiling.cprofile(args.cprofile) if args.cprofile else contextlib.nullcontext():
+            render(args, options)
+    finally:
+        if args.profile:
+            profiler.report(printer.CliPrinter())
+        if args.profile_json:
+            profiler.dump_json(args.profile_json)
+
+
+def render(args, options):
+    if args.barcode:
+        try:
+            barcode.render_barcode(
+                args.movie_file, args.output_name, seconds_increment=args.barcode_seconds,
+                height=args.barcode_height, mode=args.barcode
+            )
+        except Exception as e:
+            raise AppException(e)
+        return
+
+    if not args.batch:
+        try:
+            if args.compose_only:
+                compose_from_work_dir(
+                    args.work_dir, args.frames_per_row, args.output_name,
+                    compositor=args.compositor, row_spacing=args.row_spacing, dedup_threshold=args.dedup,
+                    frame_store=args.frame_store, profiler=options['profiler'], compress_level=args.compress_level,
+                    encode_jobs=args.encode_jobs, sizes=args.sizes, resample=args.resample
+                )
+            else:
+                if args.max_memory:
+                    # settle how to run from the movie's metadata, before anything is decoded
+                    plan = planner.plan_render(
+                        probe.probe_movie(args.movie_file), args.sizes or [(args.thumbnail_width, args.output_name)],
+                        args.seconds_between_frames, args.frames_per_row, args.max_memory * 1024 * 1024,
+                        extractor=args.extractor, jobs=args.jobs, compositor=args.compositor,
+                        frame_store=args.frame_store, encode_jobs=args.encode_jobs, row_spacing=args.row_spacing,
+                        max_frames=args.max_frames
+                    )
+                    planner.print_plan(plan, printer.CliPrinter())
+                    options.update(plan.options())
+
+                doit(
+                    args.movie_file, output_filename=args.output_name, work_dir=args.work_dir,
+                    resume=args.resume, extract_only=args.extract_only, sizes=args.sizes, **options
+                )
+        except (WorkDirException, planner.PlanException) as e:
+            raise AppException(e)
+        return
+
+    prntr = printer.CliPrinter()
+
+    try:
+        results = batch.run_batch(
+            args.movies, args.output_name, options, workers=args.batch_workers, prntr=prntr,
+            max_memory=args.max_memory * 1024 * 1024 if args.max_memory else None
+        )
+    except Exception as e:
+        raise AppException(e)
+
+    batch.print_summary(results, prntr)
+
+    failures = [result for result in results if result[3] is not None]
+    if failures:
+        raise AppException('{} of {} movies failed'.format(len(failures), len(results)))
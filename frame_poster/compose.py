@@ -0,0 +1,764 @@
+import collections
+import concurrent.futures
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+import numpy
+from PIL import Image
+
+from . import store
+
+DPI = 300
+
+# number of pixel rows handled at once when encoding a poster
+ENCODE_BAND_HEIGHT = 64
+
+# edge length of the square tiles in a TIFF
+TIFF_TILE_SIZE = 256
+
+# deflate level for PNG and TIFF output, from 0 (stored) to 9; past 3 the output
+# shrinks by a few percent for twice the time, as rows are filtered first
+COMPRESS_LEVEL = 3
+
+# threads compressing bands of the poster at once
+ENCODE_JOBS = os.cpu_count() or 1
+
+# the last 32KB of each band primes the compressor of the next, as one deflate stream would
+DEFLATE_WINDOW = 32 * 1024
+
+# classic TIFF offsets are 32-bit; anything bigger is written as BigTIFF
+TIFF_MAX_CLASSIC_SIZE = 2 ** 32 - 2 ** 20
+
+# tiles in a Deep Zoom pyramid: their edge length, format, and JPEG quality
+DZI_TILE_SIZE = 256
+DZI_TILE_FORMAT = 'jpg'
+DZI_JPEG_QUALITY = 90
+
+# rough compression ratios against raw RGB, for estimating compressed file sizes
+ESTIMATE_COMPRESSION_RATIOS = {
+    'PNG': 0.4,
+    'TIFF': 0.4,
+    'JPEG': 0.1,
+}
+
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_RATIONAL = 5
+TIFF_LONG8 = 16
+
+# struct format for each TIFF field type (a RATIONAL is a pair of LONGs)
+TIFF_TYPE_FORMATS = {TIFF_SHORT: 'H', TIFF_LONG: 'I', TIFF_RATIONAL: 'I', TIFF_LONG8: 'Q'}
+
+
+def row_spacing_for(thumbnail_height, row_spacing=None):
+    # black spacing between rows defaults to a third of the thumbnail height
+    if row_spacing is None:
+        return round(thumbnail_height / 3)
+    return row_spacing
+
+
+def poster_height(num_frames, frames_per_row, thumbnail_height, spacing):
+    # image height is number of rows * height + black spacing between rows
+    num_rows = -(-num_frames // frames_per_row)
+    return (thumbnail_height * num_rows) + (spacing * (num_rows + 1))
+
+
+class RowCompositor:
+    '''
+    Pastes thumbnails into a single row strip, handing each strip to the
+    writer as soon as the row is full. Only one row is held in memory,
+    however long the movie is.
+    '''
+    def __init__(self, writer, frames_per_row, thumbnail_width, row_spacing=None):
+        self.writer = writer
+        self.frames_per_row = frames_per_row
+        self.thumbnail_width = thumbnail_width
+        self.row_spacing = row_spacing
+
+        self.thumbnail_height = None
+        self.spacing = None
+        self.row = None
+        self.column = 0
+        self.num_frames = 0
+        self.num_rows = 0
+
+    def add(self, im):
+        if self.thumbnail_height is None:
+            # thumbnails will be the width specified, and height is based on the ratio
+            self.thumbnail_height = im.size[1]
+            self.spacing = row_spacing_for(self.thumbnail_height, self.row_spacing)
+
+        if self.row is None:
+            # each strip carries the black spacing above its row
+            self.row = Image.new('RGB', (self.writer.width, self.spacing + self.thumbnail_height))
+
+        self.row.paste(im, (self.column * self.thumbnail_width, self.spacing))
+        self.column += 1
+        self.num_frames += 1
+
+        if self.column == self.frames_per_row:
+            self._flush_row()
+
+    def close(self):
+        if self.row is not None:
+            # partially filled last row
+            self._flush_row()
+
+        if self.num_rows:
+            # black spacing below the last row
+            self.writer.write(Image.new('RGB', (self.writer.width, self.spacing)))
+
+    def _flush_row(self):
+        self.writer.write(self.row)
+        self.row = None
+        self.column = 0
+        self.num_rows += 1
+
+
+class CanvasCompositor:
+    '''
+    Pastes each thumbnail straight into its place on a canvas held outside
+    the Python heap, growing the canvas a row at a time as needed
+    '''
+    def __init__(self, canvas, frames_per_row, thumbnail_width, row_spacing=None, expected_frames=None):
+        self.canvas = canvas
+        self.frames_per_row = frames_per_row
+        self.thumbnail_width = thumbnail_width
+        self.row_spacing = row_spacing
+        self.expected_frames = expected_frames
+
+        self.thumbnail_height = None
+        self.spacing = None
+        self.num_frames = 0
+
+    def add(self, im):
+        if self.thumbnail_height is None:
+            # thumbnails will be the width specified, and height is based on the ratio
+            self.thumbnail_height = im.size[1]
+            self.spacing = row_spacing_for(self.thumbnail_height, self.row_spacing)
+
+            # size the canvas for the whole movie up front, if we know how long it is
+            if self.expected_frames:
+                self.canvas.resize(self.output_height(self.expected_frames))
+
+        row, column = divmod(self.num_frames, self.frames_per_row)
+
+        # set y co-ordinate for this row, including space between rows
+        y = (row * self.thumbnail_height) + (self.spacing * (row + 1))
+
+        if y + self.thumbnail_height + self.spacing > self.canvas.height:
+            self.canvas.resize(y + self.thumbnail_height + self.spacing)
+
+        self.canvas.paste(im, (column * self.thumbnail_width, y))
+        self.num_frames += 1
+
+    def close(self):
+        if self.num_frames:
+            # trim any rows allocated for frames which never arrived
+            self.canvas.resize(self.output_height(self.num_frames))
+
+    def output_height(self, num_frames):
+        return poster_height(num_frames, self.frames_per_row, self.thumbnail_height, self.spacing)
+
+
+class ArrayCompositor:
+    '''
+    Holds every thumbnail in a FrameStore, compressed unless the store is
+    raw, and lays out the poster on the canvas once the last thumbnail has
+    arrived
+    '''
+    def __init__(self, canvas, frames_per_row, thumbnail_width, row_spacing=None, frame_store=store.FRAME_STORE, expected_frames=None):
+        self.canvas = canvas
+        self.frames_per_row = frames_per_row
+        self.thumbnail_width = thumbnail_width
+        self.row_spacing = row_spacing
+
+        self.frames = store.FrameStore(frame_store, expected_frames)
+        self.thumbnail_height = None
+
+    @property
+    def num_frames(self):
+        return len(self.frames)
+
+    def add(self, im):
+        if self.thumbnail_height is None:
+            # thumbnails will be the width specified, and height is based on the ratio
+            self.thumbnail_height = im.size[1]
+
+        self.frames.add(im)
+
+    def close(self):
+        if not self.frames:
+            return
+
+        self.canvas.layout(
+            self.frames, self.frames_per_row, self.thumbnail_width, self.thumbnail_height,
+            row_spacing_for(self.thumbnail_height, self.row_spacing)
+        )
+
+
+class MappedCanvas:
+    '''
+    A raw RGB canvas in a memory-mapped temp file, so a poster bigger than
+    RAM is paged to disk by the OS rather than held in memory
+    '''
+    def __init__(self, width, tmpdir=None):
+        self.width = width
+        self.height = 0
+        self.f = tempfile.TemporaryFile(dir=tmpdir)
+        self.mm = None
+
+    def resize(self, height):
+        size = max(height, 1) * self.width * 3
+
+        # new rows are zero-filled, which is black
+        if self.mm is None:
+            self.f.truncate(size)
+            self.mm = mmap.mmap(self.f.fileno(), size)
+        else:
+            self.mm.resize(size)
+
+        self.height = height
+
+    def paste(self, im, xy):
+        x, y = xy
+        width, height = im.size
+        data = memoryview(im.convert('RGB').tobytes())
+
+        # copy the thumbnail into the mapped region a pixel row at a time
+        for row in range(height):
+            offset = ((y + row) * self.width + x) * 3
+            self.mm[offset:offset + width * 3] = data[row * width * 3:(row + 1) * width * 3]
+
+    def read_rows(self, y, num_rows):
+        return self.mm[y * self.width * 3:(y + num_rows) * self.width * 3]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.close()
+
+
+class RowSpool:
+    '''
+    Appends strips of the poster to a raw RGB file on disk, to be encoded
+    into the output image once all rows are known
+    '''
+    def __init__(self, width, tmpdir=None):
+        self.width = width
+        self.height = 0
+        self.f = tempfile.TemporaryFile(dir=tmpdir)
+
+    def write(self, strip):
+        self.f.write(strip.tobytes())
+        self.height += strip.size[1]
+
+    def read_rows(self, y, num_rows):
+        self.f.flush()
+        self.f.seek(y * self.width * 3)
+        return self.f.read(num_rows * self.width * 3)
+
+    def close(self):
+        self.f.close()
+
+
+class ArrayCanvas:
+    '''
+    A poster laid out from the thumbnails in a FrameStore, read by rows like
+    the other canvases. Only the row of thumbnails being read is decoded, so
+    the whole poster is never held in memory uncompressed.
+    '''
+    def __init__(self, width):
+        self.width = width
+        self.height = 0
+        self.frames = None
+
+        # the last row of thumbnails decoded, as (index, array)
+        self.row = None
+
+    def layout(self, frames, frames_per_row, thumbnail_width, thumbnail_height, spacing):
+        self.frames = frames
+        self.frames_per_row = frames_per_row
+        self.thumbnail_width = thumbnail_width
+        self.thumbnail_height = thumbnail_height
+        self.spacing = spacing
+
+        self.num_rows = -(-len(frames) // frames_per_row)
+        self.height = poster_height(len(frames), frames_per_row, thumbnail_height, spacing)
+
+    def read_rows(self, y, num_rows):
+        band = numpy.zeros((num_rows, self.width, 3), dtype=numpy.uint8)
+        pitch = self.spacing + self.thumbnail_height
+
+        # each row of thumbnails sits below its spacing; copy the part of each row inside the band
+        for index in range(max(y // pitch, 0), min((y + num_rows) // pitch + 1, self.num_rows)):
+            top = index * pitch + self.spacing
+            start, end = max(top, y), min(top + self.thumbnail_height, y + num_rows)
+            if start < end:
+                band[start - y:end - y] = self._decode_row(index)[start - top:end - top]
+
+        return band.tobytes()
+
+    def close(self):
+        if self.frames is not None:
+            self.frames.close()
+        self.frames = self.row = None
+
+    def _decode_row(self, index):
+        if self.row is None or self.row[0] != index:
+            row = numpy.zeros((self.thumbnail_height, self.width, 3), dtype=numpy.uint8)
+            start, stop = index * self.frames_per_row, min((index + 1) * self.frames_per_row, len(self.frames))
+
+            frames = self.frames.get_range(start, stop)
+            if frames is not None and frames.shape[1:3] == (self.thumbnail_height, self.thumbnail_width):
+                # raw thumbnails lie end to end as (column, y, x); view the row as (y, column, x) cells
+                # and copy them all in one go
+                row[:, :(stop - start) * self.thumbnail_width].reshape(
+                    self.thumbnail_height, stop - start, self.thumbnail_width, 3
+                )[:] = frames.transpose(1, 0, 2, 3)
+            else:
+                # compressed thumbnails are decoded one at a time anyway
+                for column, i in enumerate(range(start, stop)):
+                    frame = self.frames.get(i)
+                    x = column * self.thumbnail_width
+                    row[:frame.shape[0], x:x + frame.shape[1]] = frame
+
+            self.row = (index, row)
+
+        return self.row[1]
+
+
+def save_rows(source, output_filename, dpi=DPI, compress_level=COMPRESS_LEVEL, jobs=ENCODE_JOBS):
+    '''
+    Encode a poster from a row source (a RowSpool, MappedCanvas or
+    ArrayCanvas) to output_filename, in the format given by its suffix. A
+    .dzi suffix writes a Deep Zoom tile pyramid.
+
+    Raises KeyError for an unknown file suffix, as Image.save did.
+    '''
+    ext = os.path.splitext(output_filename)[1].lower()
+    if ext == '.dzi':
+        write_dzi(source, output_filename, jobs=jobs)
+        return
+
+    fmt = Image.registered_extensions()[ext]
+
+    with open(output_filename, 'wb') as f:
+        write_rows(source, f, fmt, dpi, compress_level, jobs)
+
+
+def write_rows(source, f, fmt, dpi=DPI, compress_level=COMPRESS_LEVEL, jobs=ENCODE_JOBS):
+    '''
+    Encode a poster from a row source to the file object f, in the Pillow
+    format fmt. BMP, PNG, PPM and tiled TIFF are written a band of rows at a
+    time, with PNG and TIFF bands compressed on jobs threads; other formats
+    are handed to Pillow, which needs the whole image in memory.
+    '''
+    if fmt == 'BMP':
+        write_bmp(source, f, dpi)
+    elif fmt == 'PNG':
+        write_png(source, f, dpi, compress_level, jobs)
+    elif fmt == 'PPM':
+        write_ppm(source, f)
+    elif fmt == 'TIFF':
+        write_tiff(source, f, dpi, compress_level, jobs)
+    else:
+        im = Image.frombytes('RGB', (source.width, source.height), source.read_rows(0, source.height))
+        im.save(f, format=fmt, dpi=(dpi, dpi))
+
+
+def estimate_file_sizes(width, height):
+    '''
+    Return (format, bytes, exact) for each output format. Uncompressed
+    formats are sized exactly from their headers and padding.
+    '''
+    raw_size = width * height * 3
+
+    # BMP rows are padded to four bytes; TIFF tiles are padded to a whole tile
+    bmp_size = 54 + ((width * 3 + 3) & ~3) * height
+    ppm_size = len('P6\n{} {}\n255\n'.format(width, height)) + raw_size
+    tiff_tiles = -(-width // TIFF_TILE_SIZE) * -(-height // TIFF_TILE_SIZE)
+    tiff_size = tiff_tiles * TIFF_TILE_SIZE * TIFF_TILE_SIZE * 3 * ESTIMATE_COMPRESSION_RATIOS['TIFF']
+
+    return [
+        ('BMP', bmp_size, True),
+        ('PPM', ppm_size, True),
+        ('TIFF', int(tiff_size), False),
+        ('PNG', int(raw_size * ESTIMATE_COMPRESSION_RATIOS['PNG']), False),
+        ('JPEG', int(raw_size * ESTIMATE_COMPRESSION_RATIOS['JPEG']), False),
+    ]
+
+
+def iter_bands(source, reverse=False, band_height=ENCODE_BAND_HEIGHT):
+    # yield (y, band image) for each band of rows in the source
+    bands = range(0, source.height, band_height)
+    if reverse:
+        bands = reversed(bands)
+
+    for y in bands:
+        num_rows = min(band_height, source.height - y)
+        yield y, Image.frombytes('RGB', (source.width, num_rows), source.read_rows(y, num_rows))
+
+
+def write_bmp(source, f, dpi=DPI):
+    # BMP rows are BGR, padded to four bytes, and stored bottom-up
+    stride = (source.width * 3 + 3) & ~3
+    pixels_per_metre = int(round(dpi / 0.0254))
+
+    f.write(struct.pack('<2sIHHI', b'BM', 54 + stride * source.height, 0, 0, 54))
+    f.write(struct.pack(
+        '<IiiHHIIiiII', 40, source.width, source.height, 1, 24, 0,
+        stride * source.height, pixels_per_metre, pixels_per_metre, 0, 0
+    ))
+
+    for _, band in iter_bands(source, reverse=True):
+        f.write(band.tobytes('raw', ('BGR', stride, -1)))
+
+
+def write_png(source, f, dpi=DPI, compress_level=COMPRESS_LEVEL, jobs=ENCODE_JOBS):
+    '''
+    Write a PNG whose image data is one zlib stream, deflated a band at a
+    time on jobs threads. Each band is compressed on its own, primed with the
+    end of the band before, and flushed to a byte boundary so the pieces join
+    into a stream any decoder reads.
+    '''
+    pixels_per_metre = int(round(dpi / 0.0254))
+
+    f.write(b'\x89PNG\r\n\x1a\n')
+    _write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', source.width, source.height, 8, 2, 0, 0, 0))
+    _write_png_chunk(f, b'pHYs', struct.pack('>IIB', pixels_per_metre, pixels_per_metre, 1))
+
+    # zlib header: deflate with a 32KB window, a hint of the compression level, and check bits
+    level_hint = 0 if compress_level < 2 else 1 if compress_level < 6 else 2 if compress_level == 6 else 3
+    header = 0x7800 | (level_hint << 6)
+    header += 31 - header % 31
+    data = struct.pack('>H', header)
+    adler = 1
+
+    for scanlines, compressed in map_bands(_deflate_png_band, _png_bands(source, compress_level), jobs):
+        adler = zlib.adler32(scanlines, adler)
+        data += compressed
+        if data:
+            _write_png_chunk(f, b'IDAT', data)
+        data = b''
+
+    _write_png_chunk(f, b'IDAT', data + struct.pack('>I', adler & 0xffffffff))
+    _write_png_chunk(f, b'IEND', b'')
+
+
+def _png_bands(source, compress_level):
+    # (scanlines, dictionary, level, last) for each band of rows in the source
+    bands = range(0, source.height, ENCODE_BAND_HEIGHT)
+    previous = None
+
+    for y in bands:
+        num_rows = min(ENCODE_BAND_HEIGHT, source.height - y)
+        rows = numpy.frombuffer(source.read_rows(y, num_rows), dtype=numpy.uint8).reshape(num_rows, source.width, 3)
+
+        # each scanline is prefixed with filter type 1 (sub), the difference from the pixel to the left
+        scanlines = numpy.empty((num_rows, source.width * 3 + 1), dtype=numpy.uint8)
+        scanlines[:, 0] = 1
+        scanlines[:, 1:4] = rows[:, 0]
+        numpy.subtract(rows[:, 1:], rows[:, :-1], out=scanlines[:, 4:].reshape(num_rows, source.width - 1, 3))
+        scanlines = scanlines.tobytes()
+
+        yield scanlines, previous, compress_level, y + num_rows == source.height
+        previous = scanlines[-DEFLATE_WINDOW:]
+
+
+def _deflate_png_band(band):
+    scanlines, dictionary, compress_level, last = band
+
+    # raw deflate, as the zlib header and checksum are written around the whole stream
+    if dictionary:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+
+    compressed = compressor.compress(scanlines) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return scanlines, compressed
+
+
+def _write_png_chunk(f, chunk_type, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def write_ppm(source, f):
+    f.write('P6\n{} {}\n255\n'.format(source.width, source.height).encode('ascii'))
+
+    for _, band in iter_bands(source):
+        f.write(band.tobytes())
+
+
+def write_tiff(source, f, dpi=DPI, compress_level=COMPRESS_LEVEL, jobs=ENCODE_JOBS):
+    '''
+    Write RGB in square tiles, deflated with a horizontal predictor a band of
+    tiles at a time on jobs threads, or uncompressed at compress_level 0.
+    Switches to BigTIFF when 32-bit offsets won't do.
+    '''
+    tile_size = TIFF_TILE_SIZE
+    tiles_across = -(-source.width // tile_size)
+    tile_bytes = tile_size * tile_size * 3
+
+    # deflate can grow incompressible data by a few bytes in every 16KB
+    max_tile_bytes = tile_bytes + (tile_bytes // 16384 + 1) * 5 + 6 if compress_level else tile_bytes
+    bigtiff = tiles_across * -(-source.height // tile_size) * max_tile_bytes > TIFF_MAX_CLASSIC_SIZE
+
+    if bigtiff:
+        f.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, 0))
+    else:
+        f.write(struct.pack('<2sHI', b'II', 42, 0))
+
+    offsets = []
+    byte_counts = []
+    for tiles in map_bands(_encode_tiff_band, _tiff_bands(source, compress_level), jobs):
+        for tile in tiles:
+            offsets.append(f.tell())
+            byte_counts.append(len(tile))
+            f.write(tile)
+
+    entries = [
+        (256, TIFF_LONG, [source.width]),                # ImageWidth
+        (257, TIFF_LONG, [source.height]),               # ImageLength
+        (258, TIFF_SHORT, [8, 8, 8]),                    # BitsPerSample
+        (259, TIFF_SHORT, [8 if compress_level else 1]), # Compression: deflate or none
+        (262, TIFF_SHORT, [2]),                          # PhotometricInterpretation: RGB
+        (277, TIFF_SHORT, [3]),                          # SamplesPerPixel
+        (282, TIFF_RATIONAL, [dpi, 1]),                  # XResolution
+        (283, TIFF_RATIONAL, [dpi, 1]),                  # YResolution
+        (284, TIFF_SHORT, [1]),                          # PlanarConfiguration: contiguous
+        (296, TIFF_SHORT, [2]),                          # ResolutionUnit: inch
+        (317, TIFF_SHORT, [2 if compress_level else 1]), # Predictor: horizontal differencing or none
+        (322, TIFF_LONG, [tile_size]),                   # TileWidth
+        (323, TIFF_LONG, [tile_size]),                   # TileLength
+        (324, TIFF_LONG8 if bigtiff else TIFF_LONG, offsets),  # TileOffsets
+        (325, TIFF_LONG, byte_counts),                   # TileByteCounts
+    ]
+    _write_tiff_ifd(f, entries, bigtiff)
+
+
+def _tiff_bands(source, compress_level):
+    # (band, compress_level) for each band of tiles, as an array padded with black to whole tiles
+    tile_size = TIFF_TILE_SIZE
+    padded_width = -(-source.width // tile_size) * tile_size
+
+    for y in range(0, source.height, tile_size):
+        num_rows = min(tile_size, source.height - y)
+        band = numpy.zeros((tile_size, padded_width, 3), dtype=numpy.uint8)
+        band[:num_rows, :source.width] = numpy.frombuffer(
+            source.read_rows(y, num_rows), dtype=numpy.uint8
+        ).reshape(num_rows, source.width, 3)
+        yield band, compress_level
+
+
+def _encode_tiff_band(band):
+    # the tiles of one band, left to right
+    band, compress_level = band
+    tiles = []
+
+    for x in range(0, band.shape[1], TIFF_TILE_SIZE):
+        tile = band[:, x:x + TIFF_TILE_SIZE]
+
+        if compress_level:
+            # horizontal predictor: each sample less the same sample of the pixel to the left
+            predicted = tile.copy()
+            numpy.subtract(tile[:, 1:], tile[:, :-1], out=predicted[:, 1:])
+            tiles.append(zlib.compress(predicted.tobytes(), compress_level))
+        else:
+            tiles.append(tile.tobytes())
+
+    return tiles
+
+
+def write_dzi(source, output_filename, tile_size=DZI_TILE_SIZE, tile_format=DZI_TILE_FORMAT, jobs=ENCODE_JOBS):
+    '''
+    Write a Deep Zoom pyramid for viewers such as OpenSeadragon: the .dzi
+    descriptor at output_filename, and a _files directory alongside with a
+    directory of tiles per level, from 0 (a single pixel) to the full poster.
+
+    Each level is made by halving the level above as its rows stream past,
+    so only a band of rows per level is in memory. Tiles are encoded on jobs
+    threads.
+    '''
+    tiles_dir = '{}_files'.format(os.path.splitext(output_filename)[0])
+    num_levels = (max(source.width, source.height) - 1).bit_length() + 1
+
+    # tiles are written alongside and renamed, so an interrupted render never leaves a partial pyramid
+    tmp_dir = '{}.tmp'.format(tiles_dir)
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    for level in range(num_levels):
+        os.makedirs(os.path.join(tmp_dir, str(level)))
+
+    for _ in map_bands(_save_dzi_tile, _dzi_tiles(source, num_levels, tile_size, tile_format, tmp_dir), jobs):
+        pass
+
+    if os.path.exists(tiles_dir):
+        shutil.rmtree(tiles_dir)
+    os.rename(tmp_dir, tiles_dir)
+
+    with open(output_filename, 'w') as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{}" Overlap="0" Format="{}">\n'
+            '  <Size Width="{}" Height="{}"/>\n'
+            '</Image>\n'.format(tile_size, tile_format, source.width, source.height)
+        )
+
+
+class DziLevel:
+    '''
+    One level of a Deep Zoom pyramid. Rows are cut into tiles as each
+    tile_size rows arrive, and handed on at half size to the level below.
+    Finished tiles are appended to tiles as (filename, pixels).
+    '''
+    def __init__(self, directory, tile_size, tile_format, tiles, below=None):
+        self.directory = directory
+        self.tile_size = tile_size
+        self.tile_format = tile_format
+        self.tiles = tiles
+        self.below = below
+
+        self.pending = numpy.empty((0, 0, 3), dtype=numpy.uint8)
+        self.num_tile_rows = 0
+
+        # an odd row left over from halving, paired with the next rows to arrive
+        self.carry = None
+
+    def add(self, rows):
+        self.pending = numpy.concatenate([self.pending, rows]) if len(self.pending) else rows
+        while len(self.pending) >= self.tile_size:
+            self._cut_tiles(self.tile_size)
+
+        if self.below is None:
+            return
+
+        if self.carry is not None:
+            rows = numpy.concatenate([self.carry, rows])
+            self.carry = None
+        if len(rows) % 2:
+            self.carry = rows[-1:]
+            rows = rows[:-1]
+        if len(rows):
+            self.below.add(halve(rows))
+
+    def close(self):
+        if len(self.pending):
+            self._cut_tiles(len(self.pending))
+
+        if self.below is not None:
+            if self.carry is not None:
+                self.below.add(halve(self.carry))
+            self.below.close()
+
+    def _cut_tiles(self, num_rows):
+        band, self.pending = self.pending[:num_rows], self.pending[num_rows:]
+
+        for column, x in enumerate(range(0, band.shape[1], self.tile_size)):
+            filename = os.path.join(self.directory, '{}_{}.{}'.format(column, self.num_tile_rows, self.tile_format))
+            self.tiles.append((filename, band[:, x:x + self.tile_size]))
+
+        self.num_tile_rows += 1
+
+
+def halve(rows):
+    # average each 2x2 block of pixels, repeating the last row or column of an odd-sized band
+    if len(rows) % 2:
+        rows = numpy.concatenate([rows, rows[-1:]])
+    if rows.shape[1] % 2:
+        rows = numpy.concatenate([rows, rows[:, -1:]], axis=1)
+
+    total = rows[0::2, 0::2].astype(numpy.uint16) + rows[1::2, 0::2] + rows[0::2, 1::2] + rows[1::2, 1::2]
+    return ((total + 2) >> 2).astype(numpy.uint8)
+
+
+def _dzi_tiles(source, num_levels, tile_size, tile_format, tiles_dir):
+    # (filename, pixels) for each tile of the pyramid, as bands of the source are halved down the levels
+    tiles = []
+
+    level = None
+    for number in range(num_levels):
+        level = DziLevel(os.path.join(tiles_dir, str(number)), tile_size, tile_format, tiles, below=level)
+
+    for y in range(0, source.height, tile_size):
+        num_rows = min(tile_size, source.height - y)
+        level.add(numpy.frombuffer(source.read_rows(y, num_rows), dtype=numpy.uint8).reshape(num_rows, source.width, 3))
+
+        for tile in tiles:
+            yield tile
+        del tiles[:]
+
+    level.close()
+    for tile in tiles:
+        yield tile
+
+
+def _save_dzi_tile(tile):
+    filename, pixels = tile
+    Image.fromarray(pixels).save(filename, quality=DZI_JPEG_QUALITY)
+
+
+def map_bands(func, bands, jobs=ENCODE_JOBS):
+    '''
+    Yield func(band) for each band in order, running on jobs threads. Only a
+    few bands are in flight at once, so memory stays bounded however tall
+    the poster is; zlib releases the GIL while compressing.
+    '''
+    if jobs <= 1:
+        for band in bands:
+            yield func(band)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+
+        for band in bands:
+            pending.append(executor.submit(func, band))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def _write_tiff_ifd(f, entries, bigtiff):
+    # append the IFD at the end of the file, and point the header at it
+    value_size = 8 if bigtiff else 4
+    offset_fmt = '<Q' if bigtiff else '<I'
+
+    # values too big to fit in an entry are written ahead of the IFD
+    entry_values = []
+    for tag, field_type, values in entries:
+        data = struct.pack('<{}{}'.format(len(values), TIFF_TYPE_FORMATS[field_type]), *values)
+        if len(data) > value_size:
+            if f.tell() % 2:
+                f.write(b'\0')
+            offset = f.tell()
+            f.write(data)
+            data = struct.pack(offset_fmt, offset)
+        count = len(values) // 2 if field_type == TIFF_RATIONAL else len(values)
+        entry_values.append((tag, field_type, count, data.ljust(value_size, b'\0')))
+
+    if f.tell() % 2:
+        f.write(b'\0')
+    ifd_offset = f.tell()
+
+    f.write(struct.pack('<Q' if bigtiff else '<H', len(entry_values)))
+    for tag, field_type, count, data in entry_values:
+        f.write(struct.pack('<HH', tag, field_type))
+        f.write(struct.pack(offset_fmt, count))
+        f.write(data)
+
+    # no further IFDs
+    f.write(struct.pack(offset_fmt, 0))
+
+    f.seek(8 if bigtiff else 4)
+    f.write(struct.pack(offset_fmt, ifd_offset))
+    f.seek(0, os.SEEK_END)
@@ -1,169 +1,899 @@
+import bisect
+import concurrent.futures
 import contextlib
 import datetime
+import functools
+import heapq
+import itertools
+import math
 import os
 import subprocess
 import shutil
 import tempfile
+import threading
+import time
 
 from PIL import Image
 
-from . import printer
+from . import cache, compose, dedup, printer, probe, profiling, store, workdir
 
 THUMBNAIL_SIZE = 240    # 1080p / 8
 SECONDS_INCREMENT = 30
 FRAMES_PER_ROW = 10
-
-
-def extract_frame(movie_filepath, tmpdir, seconds):
+EXTRACTOR = 'seek'
+JOBS = 1
+SCALER = 'ffmpeg'
+RESAMPLE = 'bicubic'
+COMPOSITOR = 'stream'
+OUTPUT_FILENAME = 'output.png'
+KEYFRAME_TOLERANCE = 1.0
+SCENE_THRESHOLD = 0.3
+
+# resample filters by name, as ffmpeg scaler flags and Pillow filters
+RESAMPLE_FILTERS = {
+    'nearest': ('neighbor', Image.NEAREST),
+    'bilinear': ('bilinear', Image.BILINEAR),
+    'bicubic': ('bicubic', Image.BICUBIC),
+    'lanczos': ('lanczos', Image.LANCZOS),
+    'area': ('area', Image.BOX),
+}
+
+CHUNKS_PER_JOB = 4
+
+
+def extract_frame(movie_filepath, tmpdir, seconds, video_filter=None):
     ts = datetime.timedelta(seconds=seconds)
     filename = '{}/output-{}.bmp'.format(tmpdir, seconds)
 
-    subprocess.check_call(
-        "ffmpeg -ss {} -i '{}' -frames:v 1 {} &>/dev/null".format(ts, movie_filepath, filename), shell=True
-    )
+    args = ['ffmpeg', '-ss', str(ts), '-i', movie_filepath, '-frames:v', '1', '-update', '1']
+    if video_filter:
+        args += ['-vf', video_filter]
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(args + [filename], stdout=devnull, stderr=devnull)
     if os.path.exists(filename):
         return filename
 
 
-def extract_movie_length(movie_filepath):
-    # TODO this function is not robust; too much awk and parsing
-    output = subprocess.check_output(
-        "ffprobe '{}' 2>&1 | awk '/Duration/ {{print $2}}'".format(movie_filepath), shell=True
-    ).decode('utf8')
+def extract_frames_seek(movie_filepath, tmpdir, seconds_increment, start=0, end=None, size=None, resample=RESAMPLE):
+    # one ffmpeg process and accurate seek per sampled timestamp
+    seconds = start
+
+    while end is None or seconds < end:
+        filename = extract_frame(movie_filepath, tmpdir, seconds, video_filter=_scale_filter(size, resample))
+        if filename is None:
+            # NOTE end of movie
+            break
 
-    if not output:
-        raise Exception('Failed calling ffprobe!')
+        yield seconds, _load_frame(filename)
+        seconds += seconds_increment
 
-    length = output.strip()[0:-4].format(':')
-    parts = length.split(':')
 
-    return datetime.timedelta(hours=int(parts[0]), minutes=int(parts[1]), seconds=int(parts[2])).seconds
+def extract_frames_pipe(movie_filepath, tmpdir, seconds_increment, start=0, end=None, size=None, resample=RESAMPLE):
+    # a single ffmpeg decode streaming rgb24 frames over stdout, so nothing
+    # touches the disk; tmpdir is unused
+    width, height = size or extract_frame_size(movie_filepath)
+    frame_size = width * height * 3
+    limit = _frame_limit(seconds_increment, start, end)
 
+    with ffmpeg_pipe(['ffmpeg'] + _input_args(movie_filepath, start, end) + [
+        '-vf', _sample_filter(seconds_increment, size, resample),
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1',
+    ]) as proc:
+        i = 0
+        while limit is None or i < limit:
+            buf = read_frames(proc.stdout, frame_size)
+            if not buf:
+                # NOTE end of movie
+                break
+
+            # wrap the buffer read from ffmpeg directly as an image
+            yield start + i * seconds_increment, Image.frombuffer('RGB', (width, height), buf, 'raw', 'RGB', 0, 1)
+            i += 1
 
-def doit(movie_filepath, thumbnail_width, seconds_increment, frames_per_row, output_filename, estimate=False):
-    # get length of movie (for approximate progress bar)
-    movie_length = extract_movie_length(movie_filepath)
+        if i == 0 and proc.wait() != 0:
+            raise Exception('Failed calling ffmpeg!')
 
-    prntr = printer.CliPrinter()
-    prntr.p('Processing {}'.format(os.path.basename(movie_filepath)))
 
-    # in-memory storage for all frame thumbnails
-    frames = []
-    current_row = i = seconds = 0
+def extract_frames_keyframe(movie_filepath, tmpdir, seconds_increment, start=0, end=None, size=None, resample=RESAMPLE, tolerance=KEYFRAME_TOLERANCE):
+    # snap each timestamp to the nearest keyframe within tolerance, and have a
+    # single ffmpeg decode only those keyframes; no decoding from the previous
+    # keyframe up to an exact timestamp
+    metadata = probe.probe_movie(movie_filepath)
+    width, height = size or metadata.frame_size
+    frame_size = width * height * 3
 
-    prntr.progressf(0, 1, movie_length)
+    timestamps = sample_timestamps(metadata.duration, seconds_increment, start, end)
+    snapped = [nearest_keyframe(metadata.keyframes, seconds, tolerance) for seconds in timestamps]
+    keyframes = sorted(set(k for k in snapped if k is not None))
+
+    # select each keyframe by a window of half a frame either side; with
+    # -copyts, timestamps in the filter are the movie's own
+    window = 0.5 / (metadata.frame_rate or 25)
+    select = "select='{}',showinfo".format('+'.join(
+        'between(t,{:.6f},{:.6f})'.format(k - window, k + window) for k in keyframes
+    ))
+
+    # showinfo prints the timestamp of each frame to stderr
+    times = _FrameTimes(scored=False)
+    pipe = contextlib.nullcontext()
+    if keyframes:
+        # a timestamp can snap to a keyframe before start, so seek to the first keyframe needed rather than start
+        seek = max(keyframes[0] - window, 0)
+        pipe = ffmpeg_pipe([
+            'ffmpeg', '-hide_banner', '-nostats', '-skip_frame', 'nokey', '-ss', str(seek),
+            '-t', str(keyframes[-1] + window - seek), '-copyts', '-i', movie_filepath,
+            '-vf', ','.join(filter(None, [select, _scale_filter(size, resample)])),
+            '-fps_mode', 'passthrough', '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1',
+        ], read_stderr=times.read)
+
+    def decoded(proc):
+        # (pts_time, image) for each keyframe, as ffmpeg sends them
+        for i in itertools.count():
+            buf = read_frames(proc.stdout, frame_size)
+            entry = times.get(i) if buf else None
+            if entry is None:
+                # NOTE end of movie
+                return
+            yield entry[0], Image.frombuffer('RGB', (width, height), buf, 'raw', 'RGB', 0, 1)
+
+    with pipe as proc:
+        frames = decoded(proc) if proc is not None else iter(())
+        frame = next(frames, None)
+        keyframe = im = None
+
+        for seconds, snapped_keyframe in zip(timestamps, snapped):
+            if snapped_keyframe is not None and snapped_keyframe == keyframe:
+                # two timestamps snapped to the same keyframe
+                yield seconds, im.copy()
+                continue
+
+            if snapped_keyframe is not None:
+                # match frames to keyframes by their timestamps, not the order they arrive in
+                while frame is not None and frame[0] < snapped_keyframe - window:
+                    frame = next(frames, None)
+
+                if frame is not None and frame[0] <= snapped_keyframe + window:
+                    keyframe, im = snapped_keyframe, frame[1]
+                    frame = next(frames, None)
+                    yield seconds, im
+                    continue
+
+            # no keyframe close enough, or ffmpeg didn't return it; fall back to an accurate seek for this frame
+            filename = extract_frame(movie_filepath, tmpdir, seconds, video_filter=_scale_filter(size, resample))
+            if filename is not None:
+                yield seconds, _load_frame(filename)
+
+
+def extract_frames_scene(movie_filepath, tmpdir, seconds_increment, start=0, end=None, size=None, resample=RESAMPLE, threshold=SCENE_THRESHOLD, max_frames=None):
+    '''
+    Pick frames at scene changes instead of at fixed intervals. A single
+    ffmpeg decode selects every frame whose scene score exceeds threshold,
+    and the max_frames with the highest scores are yielded in time order once
+    the decode is finished. The first frame is always kept.
+
+    max_frames defaults to the number of frames seconds_increment would give,
+    so the poster is the same size as one sampled at fixed intervals.
+    '''
+    metadata = probe.probe_movie(movie_filepath)
+    width, height = size or metadata.frame_size
+    frame_size = width * height * 3
+
+    if max_frames is None:
+        max_frames = count_frames(min(end or metadata.duration, metadata.duration) - start, seconds_increment)
+
+    # the metadata filter prints the timestamp and score of each selected frame to stderr
+    select = "select='eq(n,0)+gt(scene,{})',metadata=print".format(threshold)
+
+    scores = _FrameTimes()
+
+    with ffmpeg_pipe(['ffmpeg', '-hide_banner', '-nostats'] + _input_args(movie_filepath, start, end) + [
+        '-vf', ','.join(filter(None, [select, _scale_filter(size, resample)])),
+        '-fps_mode', 'passthrough', '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1',
+    ], read_stderr=scores.read) as proc:
+        # the best frames so far, as a min-heap of (score, index, seconds, image)
+        best = []
+        i = 0
 
-    with make_temp_directory() as tmpdir:
         while True:
-            # extract an image from the movie
-            filename = extract_frame(movie_filepath, tmpdir, seconds)
-            if filename is None:
+            buf = read_frames(proc.stdout, frame_size)
+            if not buf:
                 # NOTE end of movie
                 break
 
-            # load image into Pillow
-            im = Image.open(filename)
+            entry = scores.get(i)
+            if entry is None:
+                break
+            pts_time, score = entry
+
+            im = Image.frombuffer('RGB', (width, height), buf, 'raw', 'RGB', 0, 1)
+            heapq.heappush(best, (float('inf') if i == 0 else score, i, round(start + pts_time, 3), im))
+            if len(best) > max_frames:
+                heapq.heappop(best)
+            i += 1
 
-            # convert to a thumbnail (we're assuming the image is always wider than tall)
-            im.thumbnail((thumbnail_width, thumbnail_width))
-            frames.append(im)
+        if i == 0 and proc.wait() != 0:
+            raise Exception('Failed calling ffmpeg!')
+
+    for _, _, seconds, im in sorted(best, key=lambda frame: frame[1]):
+        yield seconds, im
+
+
+class _FrameTimes:
+    '''
+    (pts_time, scene score) of each frame printed by ffmpeg's metadata or
+    showinfo filters, parsed from stderr on a separate thread while frames are
+    read from stdout. Unless scored, frames have no score to wait for.
+    '''
+    def __init__(self, scored=True):
+        self.scored = scored
+        self.entries = []
+        self.finished = False
+        self.cond = threading.Condition()
+
+    def read(self, stream):
+        try:
+            for line in iter(stream.readline, b''):
+                line = line.decode('utf8', 'replace')
+
+                with self.cond:
+                    if 'pts_time:' in line:
+                        self.entries.append([float(line.split('pts_time:')[1].split()[0]), None])
+                    elif 'lavfi.scene_score=' in line and self.entries:
+                        self.entries[-1][1] = float(line.split('lavfi.scene_score=')[1])
+                    else:
+                        continue
+                    self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+
+    def get(self, i):
+        # wait until the score of the ith frame is known, or the next frame has started
+        with self.cond:
+            self.cond.wait_for(lambda: self.finished or len(self.entries) > i + 1 or (
+                len(self.entries) > i and (not self.scored or self.entries[i][1] is not None)
+            ))
+            if i < len(self.entries):
+                pts_time, score = self.entries[i]
+                return pts_time, score or 0.0
+
+
+def sample_timestamps(duration, seconds_increment, start=0, end=None):
+    # timestamps sampled in [start, end), stopping at the end of the movie
+    if end is None or end > duration:
+        end = duration
+
+    timestamps = []
+    seconds = start
+    while seconds < end:
+        timestamps.append(seconds)
+        seconds += seconds_increment
+
+    return timestamps
+
+
+def nearest_keyframe(keyframes, seconds, tolerance):
+    # the keyframe nearest to seconds, or None if there isn't one within tolerance
+    i = bisect.bisect_left(keyframes, seconds)
+    candidates = keyframes[max(i - 1, 0):i + 1]
+    if candidates:
+        keyframe = min(candidates, key=lambda k: abs(k - seconds))
+        if abs(keyframe - seconds) <= tolerance:
+            return keyframe
+
+
+def extract_frames_parallel(extractor, movie_filepath, tmpdir, seconds_increment, movie_length, jobs, process=None, size=None, resample=RESAMPLE, start=0):
+    # split the sampled timestamps into chunks, several per worker so the
+    # earliest chunks are ready to consume while later ones are still running
+    num_frames = max(movie_length - start, 0) // seconds_increment + 1
+    num_chunks = min(num_frames, jobs * CHUNKS_PER_JOB)
+    chunk_length = -(-num_frames // num_chunks) * seconds_increment
+
+    def extract_chunk(i):
+        # each worker gets its own directory, as file-based extractors name frames by sequence
+        chunk_tmpdir = os.path.join(tmpdir, 'chunk-{}'.format(i))
+        os.mkdir(chunk_tmpdir)
+
+        chunk_start = start + i * chunk_length
+        # the last chunk runs to the real end of the movie, as movie_length is truncated
+        chunk_end = chunk_start + chunk_length if i < num_chunks - 1 else None
+
+        return [
+            (seconds, process(im) if process else im)
+            for seconds, im in extractor(
+                movie_filepath, chunk_tmpdir, seconds_increment, chunk_start, chunk_end, size, resample
+            )
+        ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # map() hands results back in timestamp order
+        for frames in executor.map(extract_chunk, range(num_chunks)):
+            for seconds, im in frames:
+                yield seconds, im
+
+
+def thumbnail_size(size, thumbnail_width):
+    # fit within a thumbnail_width square keeping the aspect ratio, as Image.thumbnail does
+    width, height = size
+    scale = min(float(thumbnail_width) / width, float(thumbnail_width) / height, 1)
+    return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+
+def _sample_filter(seconds_increment, size, resample):
+    # sample a frame every seconds_increment, scaling after sampling so only kept frames are resized
+    return ','.join(filter(None, [
+        'fps=1/{}:round=up'.format(seconds_increment),
+        _scale_filter(size, resample),
+    ]))
+
+
+def _scale_filter(size, resample):
+    if size is not None:
+        return 'scale={}:{}:flags={}'.format(size[0], size[1], RESAMPLE_FILTERS[resample][0])
+
+
+def _input_args(movie_filepath, start, end):
+    # seek to the start of a chunk, and stop decoding at its end
+    args = ['-ss', str(start), '-i', movie_filepath]
+    if end is not None:
+        args += ['-t', str(end - start)]
+    return args
+
+
+def _frame_limit(seconds_increment, start, end):
+    # number of timestamps sampled in [start, end)
+    if end is not None:
+        return -(-(end - start) // seconds_increment)
 
-            # remove the source bitmap (for disk space)
-            os.remove(filename)
 
-            # when estimating we only need one frame
-            if estimate:
-                prntr.progressf(100, 1, 100)
-                break
+@contextlib.contextmanager
+def ffmpeg_pipe(args, read_stderr=None):
+    '''
+    Run ffmpeg writing raw frames to stdout, and yield the process. stderr
+    is discarded, unless read_stderr is given, which is called with it on
+    its own thread. ffmpeg is killed if it's still running on exit, such as
+    when a generator reading from it is closed early.
+    '''
+    proc = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE if read_stderr else subprocess.DEVNULL, bufsize=0
+    )
 
-            # display a nice progress bar
-            i += 1
-            prntr.progressf(i, seconds_increment, movie_length)
-            seconds += seconds_increment
+    reader = None
+    if read_stderr is not None:
+        reader = threading.Thread(target=read_stderr, args=(proc.stderr,))
+        reader.daemon = True
+        reader.start()
+
+    try:
+        yield proc
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        if reader is not None:
+            reader.join()
+            proc.stderr.close()
+
+
+def read_frames(stream, frame_size, count=1):
+    # read up to count whole frames from the pipe straight into a fresh
+    # buffer; fewer at the end of the movie, and none once it's over
+    buf = bytearray(frame_size * count)
+    view = memoryview(buf)
+    offset = 0
+
+    while offset < len(buf):
+        n = stream.readinto(view[offset:])
+        if not n:
+            break
+        offset += n
+
+    # a partial trailing frame is discarded
+    del view
+    del buf[offset - offset % frame_size:]
+    return buf
+
+
+def _load_frame(filename):
+    # load image into Pillow
+    im = Image.open(filename)
+    im.load()
+
+    # remove the source bitmap (for disk space)
+    os.remove(filename)
+    return im
+
+
+EXTRACTORS = {
+    'seek': extract_frames_seek,
+    'pipe': extract_frames_pipe,
+    'keyframe': extract_frames_keyframe,
+    'scene': extract_frames_scene,
+}
+
+
+def extract_frame_size(movie_filepath):
+    return probe.probe_movie(movie_filepath).frame_size
+
+
+def extract_movie_length(movie_filepath):
+    return probe.probe_movie(movie_filepath).length
+
+
+def doit(movie_filepath, thumbnail_width, seconds_increment, frames_per_row, output_filename, estimate=False, extractor=EXTRACTOR, jobs=JOBS, scaler=SCALER, resample=RESAMPLE, compositor=COMPOSITOR, cache_dir=None, cache_size=cache.CACHE_SIZE, temp_dir=None, prntr=None, keyframe_tolerance=KEYFRAME_TOLERANCE, work_dir=None, resume=False, extract_only=False, row_spacing=None, scene_threshold=SCENE_THRESHOLD, max_frames=None, dedup_threshold=None, frame_store=store.FRAME_STORE, profiler=None, compress_level=compose.COMPRESS_LEVEL, encode_jobs=compose.ENCODE_JOBS, sizes=None):
+    '''
+    Render a poster of movie_filepath to output_filename. With sizes, a list
+    of (thumbnail_width, output_filename), a poster is rendered for each
+    instead, all from a single extraction at the widest thumbnail_width.
+
+    Returns the output filename, or the list of them with sizes. With
+    estimate, nothing is decoded, and the estimate_poster() dict for each
+    target is returned in their place.
+    '''
+    if profiler is None:
+        profiler = profiling.NullProfiler()
+
+    # probe the movie once; later probes of it are answered from the cache
+    with profiler.stage('probe'):
+        metadata = probe.probe_movie(movie_filepath)
+
+    if prntr is None:
+        prntr = printer.CliPrinter()
+    prntr.p('Processing {}'.format(os.path.basename(movie_filepath)))
+
+    if extractor != 'scene':
+        # only scene sampling has a frame budget; otherwise every sampled frame is kept
+        max_frames = None
+
+    if sizes:
+        # extract once at the widest size; the smaller posters are resized from it
+        targets = sizes
+        thumbnail_width = max(width for width, _ in sizes)
+    else:
+        targets = [(thumbnail_width, output_filename)]
+
+    if estimate:
+        # everything needed is in the metadata; nothing is decoded
+        estimates = []
+        for width, filename in targets:
+            if sizes:
+                prntr.p('Estimate for {}'.format(filename))
+            estimates.append(
+                estimate_poster(metadata, width, seconds_increment, frames_per_row, row_spacing, max_frames)
+            )
+            print_estimate(estimates[-1], prntr)
+        return estimates if sizes else estimates[0]
+
+    thumbnails = extract_thumbnails(
+        movie_filepath, thumbnail_width, seconds_increment, extractor=extractor, jobs=jobs, scaler=scaler,
+        resample=resample, cache_dir=cache_dir, cache_size=cache_size, keyframe_tolerance=keyframe_tolerance,
+        scene_threshold=scene_threshold, max_frames=max_frames, work_dir=work_dir, resume=resume,
+        temp_dir=temp_dir, prntr=prntr, profiler=profiler
+    )
+
+    if extract_only:
+        # leave the frames in the work dir, to be laid out later with compose_from_work_dir
+        num_frames = sum(1 for _ in thumbnails)
+        prntr.p('Extracted {} frames to {}'.format(num_frames, work_dir))
+        return
+
+    output_filenames = compose_posters(
+        (im for seconds, im in thumbnails), frames_per_row, targets, compositor=compositor, row_spacing=row_spacing,
+        expected_frames=count_frames(metadata.duration, seconds_increment, max_frames),
+        dedup_threshold=dedup_threshold, frame_store=frame_store, frame_size=metadata.frame_size, resample=resample,
+        temp_dir=temp_dir, prntr=prntr, profiler=profiler, compress_level=compress_level, encode_jobs=encode_jobs
+    )
+    return output_filenames if sizes else output_filenames[0]
+
+
+def extract_thumbnails(movie_filepath, thumbnail_width, seconds_increment, extractor=EXTRACTOR, jobs=JOBS, scaler=SCALER, resample=RESAMPLE, cache_dir=None, cache_size=cache.CACHE_SIZE, keyframe_tolerance=KEYFRAME_TOLERANCE, scene_threshold=SCENE_THRESHOLD, max_frames=None, work_dir=None, resume=False, temp_dir=None, prntr=None, profiler=None):
+    '''
+    Yield (seconds, thumbnail) for each frame sampled from the movie, in
+    order, going through the thumbnail cache and work dir where they're
+    given. Progress is reported to prntr as frames arrive.
+    '''
+    if prntr is None:
+        prntr = printer.CliPrinter()
+    if profiler is None:
+        profiler = profiling.NullProfiler()
+
+    metadata = probe.probe_movie(movie_filepath)
+    movie_length = metadata.length
+
+    prntr.progressf(0, 1, movie_length)
+
+    # have ffmpeg scale frames down to thumbnail size as it decodes
+    size = None
+    if scaler == 'ffmpeg':
+        size = thumbnail_size(metadata.frame_size, thumbnail_width)
+
+    def make_thumbnail(im):
+        # convert to a thumbnail (we're assuming the image is always wider than tall); this is
+        # a no-op for frames ffmpeg already scaled
+        with profiler.stage('thumbnail'):
+            im.thumbnail((thumbnail_width, thumbnail_width), RESAMPLE_FILTERS[resample][1])
+        return im
+
+    extract_frames = EXTRACTORS[extractor]
+    # extractors decode and scale frames differently, so each caches its own
+    variant = '{}-{}-{}-{}'.format(extractor, thumbnail_width, scaler, resample)
+
+    if extractor == 'keyframe':
+        extract_frames = functools.partial(extract_frames, tolerance=keyframe_tolerance)
+        # frames snapped with one tolerance differ from those snapped with another
+        variant += '-{}'.format(keyframe_tolerance)
+
+    elif extractor == 'scene':
+        if work_dir:
+            raise workdir.WorkDirException('Frames picked by scene changes cannot be kept in a work dir')
+
+        extract_frames = functools.partial(extract_frames, threshold=scene_threshold, max_frames=max_frames)
+        # frames are picked from the whole movie at once, at irregular timestamps, so are
+        # never split across jobs or cached
+        jobs = 1
+        cache_dir = None
+
+    def decode(*args, **kwargs):
+        # time spent in ffmpeg and reading its output, apart from thumbnailing
+        return profiler.timed('decode', extract_frames(*args, **kwargs))
+
+    with make_temp_directory(temp_dir) as tmpdir:
+        def extract(start):
+            if jobs > 1:
+                # thumbnails are made in the workers, so full frames never queue up
+                return extract_frames_parallel(
+                    decode, movie_filepath, tmpdir, seconds_increment, movie_length, jobs,
+                    process=make_thumbnail, size=size, resample=resample, start=start
+                )
+            return (
+                (seconds, make_thumbnail(im))
+                for seconds, im in decode(
+                    movie_filepath, tmpdir, seconds_increment, start, size=size, resample=resample
+                )
+            )
+
+        frame_cache = None
+        if cache_dir or work_dir:
+            movie_key = cache.movie_key(movie_filepath)
+
+        if cache_dir:
+            # reuse thumbnails from earlier runs over the same movie
+            frame_cache = cache.FrameCache(cache_dir, cache_size * 1024 * 1024)
+            extract_uncached = extract
+
+            def extract(start):
+                return cache.cached_frames(
+                    frame_cache, movie_key, variant, seconds_increment, extract_uncached, start, metadata.duration
+                )
+
+        strip = None
+        if work_dir:
+            # keep every thumbnail in the work dir as it's extracted, so the render can be resumed
+            strip = workdir.FrameStrip(work_dir)
+            params = {
+                'movie': os.path.abspath(movie_filepath),
+                'movie_key': movie_key,
+                'variant': variant,
+                'thumbnail_width': thumbnail_width,
+                'seconds_increment': seconds_increment,
+            }
+            if resume:
+                strip.resume(params)
+                prntr.p('Resuming from {} frames in {}'.format(strip.num_frames, work_dir))
+            else:
+                strip.start(params)
+
+            extracted = workdir.checkpointed_frames(strip, seconds_increment, extract)
+        else:
+            extracted = extract(0)
+
+        try:
+            for i, (seconds, im) in enumerate(extracted):
+                yield seconds, im
+
+                # display a nice progress bar
+                prntr.progressf(i + 1, seconds_increment, movie_length)
+        finally:
+            if strip is not None:
+                strip.close()
 
         # end progress bar
         prntr.close()
 
-    if estimate:
-        prntr.p('Movie length: {}'.format(movie_length))
-        prntr.p('Frame dimensions: {}x{} pixels, or {:.2f}x{:.2f} cm at 300 dpi'.format(
-            frames[0].size[0], frames[0].size[1], frames[0].size[0] / 300 * 2.54, frames[0].size[1] / 300 * 2.54
-        ))
+        if frame_cache is not None:
+            profiler.count('cache hits', frame_cache.hits)
+            profiler.count('cache misses', frame_cache.misses)
+
+            if frame_cache.hits:
+                prntr.p('Loaded {} frames from cache'.format(frame_cache.hits))
+
+
+def compose_from_work_dir(work_dir, frames_per_row, output_filename, compositor=COMPOSITOR, row_spacing=None, dedup_threshold=None, frame_store=store.FRAME_STORE, prntr=None, profiler=None, compress_level=compose.COMPRESS_LEVEL, encode_jobs=compose.ENCODE_JOBS, sizes=None, resample=RESAMPLE):
+    '''
+    Lay out a poster from the frames already extracted to a work dir, without
+    touching the movie. Only the layout can change between runs; the timing of
+    the thumbnails is fixed by the extraction, and with sizes they can only be
+    made smaller.
+    '''
+    if prntr is None:
+        prntr = printer.CliPrinter()
+
+    strip = workdir.FrameStrip(work_dir)
+    strip.load()
+
+    if not strip.complete:
+        raise workdir.WorkDirException(
+            'Extraction in {} is incomplete; run with --resume to finish it'.format(work_dir)
+        )
+
+    prntr.p('Composing {} frames of {} from {}'.format(
+        strip.num_frames, os.path.basename(strip.manifest['movie']), work_dir
+    ))
+
+    if profiler is None:
+        profiler = profiling.NullProfiler()
+
+    thumbnail_width = strip.manifest['thumbnail_width']
 
-        # estimate final poster size and exit
-        output_width = thumbnail_width * frames_per_row
-        output_height = (frames[0].size[1] * movie_length / frames_per_row) + (round(frames[0].size[1] / 3) * ((movie_length / frames_per_row) + 1))
+    targets = sizes or [(thumbnail_width, output_filename)]
+    if max(width for width, _ in targets) > thumbnail_width:
+        raise workdir.WorkDirException(
+            'Frames in {} were extracted {}px wide, and cannot be made bigger'.format(work_dir, thumbnail_width)
+        )
 
-        prntr.p('Estimated image size is {}x{} pixels, or {:.2f}x{:.2f} cm at 300 dpi'.format(
-            output_width, round(output_height), output_width / 300 * 2.54, output_height / 300 * 2.54
+    output_filenames = compose_posters(
+        (im for seconds, im in profiler.timed('read work dir', strip.frames())), frames_per_row, targets,
+        compositor=compositor, row_spacing=row_spacing, expected_frames=strip.num_frames,
+        dedup_threshold=dedup_threshold, frame_store=frame_store, resample=resample, prntr=prntr,
+        profiler=profiler, compress_level=compress_level, encode_jobs=encode_jobs
+    )
+    return output_filenames if sizes else output_filenames[0]
+
+
+def compose_poster(thumbnails, frames_per_row, thumbnail_width, output_filename, compositor=COMPOSITOR, row_spacing=None, expected_frames=None, dedup_threshold=None, frame_store=store.FRAME_STORE, prntr=None, profiler=None, compress_level=compose.COMPRESS_LEVEL, encode_jobs=compose.ENCODE_JOBS):
+    '''
+    Lay out an iterable of thumbnails in rows and write the poster to
+    output_filename, compressing PNG and TIFF at compress_level on
+    encode_jobs threads. Returns the filename actually written.
+    '''
+    return compose_posters(
+        thumbnails, frames_per_row, [(thumbnail_width, output_filename)], compositor=compositor,
+        row_spacing=row_spacing, expected_frames=expected_frames, dedup_threshold=dedup_threshold,
+        frame_store=frame_store, prntr=prntr, profiler=profiler, compress_level=compress_level, encode_jobs=encode_jobs
+    )[0]
+
+
+def compose_posters(thumbnails, frames_per_row, targets, compositor=COMPOSITOR, row_spacing=None, expected_frames=None, dedup_threshold=None, frame_store=store.FRAME_STORE, frame_size=None, resample=RESAMPLE, temp_dir=None, prntr=None, profiler=None, compress_level=compose.COMPRESS_LEVEL, encode_jobs=compose.ENCODE_JOBS):
+    '''
+    Lay out an iterable of thumbnails once for each (thumbnail_width,
+    output_filename) in targets, in a single pass, and write each poster.
+    Returns the filenames actually written, in the order of targets.
+    '''
+    if prntr is None:
+        prntr = printer.CliPrinter()
+    if profiler is None:
+        profiler = profiling.NullProfiler()
+
+    canvases = compose_canvases(
+        thumbnails, frames_per_row, [width for width, _ in targets], compositor=compositor,
+        row_spacing=row_spacing, expected_frames=expected_frames, dedup_threshold=dedup_threshold,
+        frame_store=frame_store, frame_size=frame_size, resample=resample, temp_dir=temp_dir, prntr=prntr,
+        profiler=profiler
+    )
+
+    output_filenames = []
+    try:
+        for canvas, (_, output_filename) in zip(canvases, targets):
+            def save(filename):
+                compose.save_rows(canvas, filename, compress_level=compress_level, jobs=encode_jobs)
+
+            start = time.time()
+            with profiler.stage('encode'):
+                output_filename = save_output(save, output_filename, prntr)
+
+            # the encode runs after every frame is in, so its time is all added to the render
+            prntr.p('Encoded in {:.2f}s'.format(time.time() - start))
+
+            profiler.count('output bytes', os.path.getsize(output_filename))
+            output_filenames.append(output_filename)
+    finally:
+        for canvas in canvases:
+            canvas.close()
+
+    return output_filenames
+
+
+def compose_canvas(thumbnails, frames_per_row, thumbnail_width, compositor=COMPOSITOR, row_spacing=None, expected_frames=None, dedup_threshold=None, frame_store=store.FRAME_STORE, prntr=None, profiler=None):
+    '''
+    Lay out an iterable of thumbnails in rows, returning the canvas for the
+    caller to encode and close. With a dedup_threshold, thumbnails which hash
+    within that many bits of the last one kept are left out.
+    '''
+    return compose_canvases(
+        thumbnails, frames_per_row, [thumbnail_width], compositor=compositor, row_spacing=row_spacing,
+        expected_frames=expected_frames, dedup_threshold=dedup_threshold, frame_store=frame_store, prntr=prntr,
+        profiler=profiler
+    )[0]
+
+
+def compose_canvases(thumbnails, frames_per_row, thumbnail_widths, compositor=COMPOSITOR, row_spacing=None, expected_frames=None, dedup_threshold=None, frame_store=store.FRAME_STORE, frame_size=None, resample=RESAMPLE, temp_dir=None, prntr=None, profiler=None):
+    '''
+    Lay out an iterable of thumbnails once for each width in
+    thumbnail_widths, in a single pass, returning the canvases for the caller
+    to encode and close. Thumbnails are resized down to each narrower width
+    as they arrive, to the size a frame of frame_size would be given
+    (default is the thumbnail's own size), so the movie is decoded once for
+    every poster. Duplicates are dropped once, before the posters fan out.
+    '''
+    if prntr is None:
+        prntr = printer.CliPrinter()
+    if profiler is None:
+        profiler = profiling.NullProfiler()
+
+    deduplicator = None
+    if dedup_threshold is not None:
+        deduplicator = dedup.Deduplicator(dedup_threshold)
+
+        def is_duplicate(im):
+            with profiler.stage('dedup'):
+                return deduplicator.is_duplicate(im)
+
+        thumbnails = (im for im in thumbnails if not is_duplicate(im))
+
+    canvases = []
+    compositors = []
+    try:
+        for thumbnail_width in thumbnail_widths:
+            canvas, rows = make_compositor(
+                compositor, frames_per_row, thumbnail_width, row_spacing=row_spacing, expected_frames=expected_frames,
+                frame_store=frame_store, temp_dir=temp_dir
+            )
+            canvases.append(canvas)
+            compositors.append(rows)
+
+        for im in thumbnails:
+            for thumbnail_width, rows in zip(thumbnail_widths, compositors):
+                size = thumbnail_size(frame_size or im.size, thumbnail_width)
+
+                if size != im.size:
+                    with profiler.stage('resize'):
+                        thumbnail = im.resize(size, RESAMPLE_FILTERS[resample][1])
+                else:
+                    thumbnail = im
+
+                with profiler.stage('compose'):
+                    rows.add(thumbnail)
+
+        # write out the last row and the bottom spacing
+        with profiler.stage('compose'):
+            for rows in compositors:
+                rows.close()
+    except Exception:
+        for canvas in canvases:
+            canvas.close()
+        raise
+
+    num_frames = compositors[0].num_frames
+    profiler.count('frames', num_frames)
+
+    # interesting info; duplicates were extracted too, but aren't in the poster
+    if deduplicator is None:
+        prntr.p('Extracted {} frames'.format(num_frames))
+    else:
+        profiler.count('duplicates dropped', deduplicator.dropped)
+        prntr.p('Extracted {} frames'.format(deduplicator.kept + deduplicator.dropped))
+        prntr.p('Dropped {} near-duplicate frames; composed {}'.format(deduplicator.dropped, num_frames))
+
+    for canvas in canvases:
+        prntr.p('Output image is {}x{} pixels, or {:.2f}x{:.2f} cm at 300 dpi'.format(
+            canvas.width, canvas.height, canvas.width / 300 * 2.54, canvas.height / 300 * 2.54
         ))
-        return
 
-    # rearrange frames into columns and rows
-    frames_by_row = [[]]
+    return canvases
+
+
+def make_compositor(compositor, frames_per_row, thumbnail_width, row_spacing=None, expected_frames=None, frame_store=store.FRAME_STORE, temp_dir=None):
+    # an empty canvas and the compositor which lays out thumbnails on it, as (canvas, compositor)
 
-    for im in frames:
-        # store in frames array
-        frames_by_row[current_row].append(im)
+    # paste each row into the poster as soon as it's complete
+    if compositor == 'stream':
+        canvas = compose.RowSpool(thumbnail_width * frames_per_row, temp_dir)
+        rows = compose.RowCompositor(canvas, frames_per_row, thumbnail_width, row_spacing=row_spacing)
 
-        # move down to next row
-        if len(frames_by_row[current_row]) == frames_per_row:
-            current_row += 1
-            frames_by_row.append([])
+    # or, paste each frame straight into a memory-mapped canvas
+    elif compositor == 'mmap':
+        canvas = compose.MappedCanvas(thumbnail_width * frames_per_row, temp_dir)
+        rows = compose.CanvasCompositor(
+            canvas, frames_per_row, thumbnail_width, row_spacing=row_spacing, expected_frames=expected_frames
+        )
 
-    # interesting info
-    prntr.p('Extracted {} frames'.format(len(frames)))
+    # or, hold every thumbnail in memory, compressed, and lay them out as the poster is encoded
+    else:
+        canvas = compose.ArrayCanvas(thumbnail_width * frames_per_row)
+        rows = compose.ArrayCompositor(
+            canvas, frames_per_row, thumbnail_width, row_spacing=row_spacing, frame_store=frame_store,
+            expected_frames=expected_frames
+        )
 
-    # thumbnails will be the width specified, and height is based on the ratio
-    thumbnail_height = frames[0].size[1]
+    return canvas, rows
+
+
+def count_frames(duration, seconds_increment, max_frames=None):
+    # number of frames sampled at 0, seconds_increment, 2 * seconds_increment, .. before the end
+    num_frames = max(int(math.ceil(duration / seconds_increment)), 1)
+    if max_frames:
+        return min(num_frames, max_frames)
+    return num_frames
+
+
+def estimate_poster(metadata, thumbnail_width, seconds_increment, frames_per_row, row_spacing=None, max_frames=None):
+    '''
+    Work out the final poster layout from probed metadata alone, without
+    decoding a frame. Returns a dict of the frame count, thumbnail size,
+    row count, output pixel dimensions and approximate file size per format.
+    '''
+    frame_width, frame_height = thumbnail_size(metadata.frame_size, thumbnail_width)
+    num_frames = count_frames(metadata.duration, seconds_increment, max_frames)
+    num_rows = -(-num_frames // frames_per_row)
 
     # image width is simple
     output_width = thumbnail_width * frames_per_row
 
-    # image height is number of rows * height + black spacing between rows
-    output_height = (thumbnail_height * len(frames_by_row)) + (round(thumbnail_height / 3) * (len(frames_by_row) + 1))
+    output_height = compose.poster_height(
+        num_frames, frames_per_row, frame_height, compose.row_spacing_for(frame_height, row_spacing)
+    )
 
-    # interesting info
-    prntr.p('Output image is {}x{} pixels, or {:.2f}x{:.2f} cm at 300 dpi'.format(
-        output_width, output_height, output_width / 300 * 2.54, output_height / 300 * 2.54
-    ))
+    return {
+        'duration': metadata.duration,
+        'num_frames': num_frames,
+        'num_rows': num_rows,
+        'frame_size': (frame_width, frame_height),
+        'output_size': (output_width, output_height),
+        'file_sizes': compose.estimate_file_sizes(output_width, output_height),
+    }
 
-    # create the final output image
-    output = Image.new('RGB', (output_width, output_height))
 
-    x = y = 0
+def print_estimate(estimate, prntr):
+    frame_width, frame_height = estimate['frame_size']
+    output_width, output_height = estimate['output_size']
 
-    # iterate all rows of frames
-    for i in range(len(frames_by_row)):
-        # set y co-ordinate for this row, including space between rows
-        y = (i * thumbnail_height) + (round(thumbnail_height / 3) * (i + 1))
+    prntr.p('Movie length: {}'.format(datetime.timedelta(seconds=round(estimate['duration']))))
+    prntr.p('Frame dimensions: {}x{} pixels, or {:.2f}x{:.2f} cm at 300 dpi'.format(
+        frame_width, frame_height, frame_width / 300 * 2.54, frame_height / 300 * 2.54
+    ))
+    prntr.p('Estimated {} frames in {} rows'.format(estimate['num_frames'], estimate['num_rows']))
+    prntr.p('Estimated image size is {}x{} pixels, or {:.2f}x{:.2f} cm at 300 dpi'.format(
+        output_width, output_height, output_width / 300 * 2.54, output_height / 300 * 2.54
+    ))
 
-        # iterate frames in this row
-        for j in range(frames_per_row):
-            x = j * thumbnail_width
+    table = [['Format', 'Size (MB)', '']]
+    for fmt, num_bytes, exact in estimate['file_sizes']:
+        table.append([fmt, '{:.1f}'.format(num_bytes / 1024 / 1024), '' if exact else 'approx'])
+    prntr.p(table, tabular=True)
 
-            try:
-                # extract frame and paste into output image at co-ordinates
-                output.paste(frames_by_row[i][j], (x, y))
-            except IndexError:
-                # end of frames
-                break
 
+def save_output(save, output_filename, prntr):
     # handle relative and absolute output filepaths
     output_filename = os.path.abspath(output_filename)
 
     try:
         # write the output file
-        output.save(output_filename, dpi=(300,300))
+        save(output_filename)
         prntr.p('Output file written to {}'.format(output_filename))
     except KeyError:
-        prntr.p('Invalid file suffix supplied; file written to output.bmp')
-        output.save('output.bmp', dpi=(300,300))
+        prntr.p('Invalid file suffix supplied; file written to {}'.format(OUTPUT_FILENAME))
+        output_filename = os.path.abspath(OUTPUT_FILENAME)
+        save(output_filename)
+
+    return output_filename
 
 
 @contextlib.contextmanager
-def make_temp_directory():
-    temp_dir = tempfile.mkdtemp()
+def make_temp_directory(parent_dir=None):
+    temp_dir = tempfile.mkdtemp(dir=parent_dir)
     try:
         yield temp_dir
     except Exception as e:
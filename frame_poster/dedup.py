@@ -0,0 +1,47 @@
+import numpy
+from PIL import Image
+
+DEDUP_THRESHOLD = 6    # bits of 64
+
+# edge length of the difference hash, in bits
+HASH_SIZE = 8
+
+
+def dhash(im):
+    '''
+    A 64-bit difference hash: the thumbnail is shrunk to 9x8 greyscale and
+    each bit records whether a pixel is brighter than its left neighbour.
+    Small changes in colour, compression or scaling leave it unchanged.
+    '''
+    pixels = numpy.asarray(im.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX), dtype=numpy.int16)
+    bits = numpy.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class Deduplicator:
+    '''
+    Drops thumbnails whose hash is within threshold bits of the last one
+    kept, so runs of black frames, title cards and static shots only appear
+    on the poster once
+    '''
+    def __init__(self, threshold=DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.previous = None
+        self.kept = self.dropped = 0
+
+    def is_duplicate(self, im):
+        digest = dhash(im)
+
+        if self.previous is not None and hamming_distance(digest, self.previous) <= self.threshold:
+            self.dropped += 1
+            return True
+
+        # compare against the last frame kept, so a slow pan still moves on eventually
+        self.previous = digest
+        self.kept += 1
+        return False
+
@@ -0,0 +1,252 @@
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+from . import compose, core, store
+
+# resident size of the Python process with NumPy and Pillow loaded, before any frames
+PYTHON_MEMORY = 40 * 1024 * 1024
+
+# an ffmpeg process, apart from its frames; it holds a few decoded frames plus one per decoding thread
+FFMPEG_MEMORY = 16 * 1024 * 1024
+FFMPEG_FRAME_BUFFERS = 8
+
+# fraction of the budget kept back for allocator overhead and anything the estimate misses
+MEMORY_HEADROOM = 0.1
+
+# formats written a band of rows at a time; anything else is encoded by Pillow from the whole image
+STREAMED_FORMATS = ('BMP', 'PNG', 'PPM', 'TIFF')
+
+
+class PlanException(Exception):
+    pass
+
+
+class Plan:
+    '''
+    How a render is run to fit in a memory budget: the extraction jobs,
+    compositor, frame store, encode jobs and temp dir, with the estimated
+    peak memory of each part of the pipeline and the disk it needs
+    '''
+    def __init__(self, jobs, compositor, frame_store, encode_jobs, temp_dir, memory, disk, max_memory, notes):
+        self.jobs = jobs
+        self.compositor = compositor
+        self.frame_store = frame_store
+        self.encode_jobs = encode_jobs
+        self.temp_dir = temp_dir
+        self.memory = memory
+        self.disk = disk
+        self.max_memory = max_memory
+        self.notes = notes
+
+    @property
+    def peak_memory(self):
+        return sum(num_bytes for _, num_bytes in self.memory)
+
+    def options(self):
+        # the planned options, as keyword arguments for core.doit
+        return dict(
+            jobs=self.jobs, compositor=self.compositor, frame_store=self.frame_store, encode_jobs=self.encode_jobs,
+            temp_dir=self.temp_dir,
+        )
+
+
+def plan_render(metadata, targets, seconds_increment, frames_per_row, max_memory, extractor=core.EXTRACTOR, jobs=core.JOBS, compositor=core.COMPOSITOR, frame_store=store.FRAME_STORE, encode_jobs=compose.ENCODE_JOBS, row_spacing=None, max_frames=None, temp_dirs=None):
+    '''
+    Pick how to render posters for each (thumbnail_width, output_filename)
+    in targets within max_memory bytes, from probed metadata alone, before
+    anything is decoded.
+
+    The options asked for are kept if they fit. Otherwise extraction jobs
+    are cut first, then encode jobs, and then compositing moves from memory
+    to a spool on disk, or back into memory when no temp dir has room.
+    Frames are never stored lossily unless that was asked for.
+
+    Raises PlanException when even the leanest plan needs more.
+    '''
+    if extractor == 'scene':
+        # scene sampling has to see the whole movie in one decode
+        jobs = 1
+
+    compositors = [(compositor, frame_store)]
+    for candidate in (('stream', frame_store), ('mmap', frame_store), ('memory', 'deflate')):
+        if candidate not in compositors and not (candidate[0] == 'memory' and frame_store == 'jpeg'):
+            compositors.append(candidate)
+
+    settings = [(j, encode_jobs) for j in range(jobs, 0, -1)]
+    settings += [(1, e) for e in range(encode_jobs - 1, 0, -1)]
+
+    if temp_dirs is None:
+        temp_dirs = candidate_temp_dirs([filename for _, filename in targets])
+
+    budget = max_memory * (1 - MEMORY_HEADROOM)
+    leanest = None
+
+    for compositor_choice, store_choice in compositors:
+        for jobs_choice, encode_jobs_choice in settings:
+            memory, disk = estimate_usage(
+                metadata, targets, seconds_increment, frames_per_row, extractor, jobs_choice, compositor_choice,
+                store_choice, encode_jobs_choice, row_spacing, max_frames
+            )
+
+            # without temp files, the temp dir makes no difference
+            for temp_dir in temp_dirs if disk else [None]:
+                if temp_dir is not None and is_memory_backed(temp_dir):
+                    # temp files in a tmpfs live in memory
+                    usage = memory + [('temp files', disk)]
+                elif temp_dir is not None and shutil.disk_usage(temp_dir).free < disk:
+                    continue
+                else:
+                    usage = memory
+
+                peak = sum(num_bytes for _, num_bytes in usage)
+                if leanest is None or peak < leanest:
+                    leanest = peak
+
+                if peak > budget:
+                    continue
+
+                notes = []
+                if jobs_choice < jobs:
+                    notes.append('extraction jobs cut from {} to {}'.format(jobs, jobs_choice))
+                if encode_jobs_choice < encode_jobs:
+                    notes.append('encode jobs cut from {} to {}'.format(encode_jobs, encode_jobs_choice))
+                if (compositor_choice, store_choice) != (compositor, frame_store):
+                    notes.append('the {} compositor is used in place of {}'.format(compositor_choice, compositor))
+
+                return Plan(
+                    jobs_choice, compositor_choice, store_choice, encode_jobs_choice, temp_dir, usage, disk,
+                    max_memory, notes
+                )
+
+    if leanest is None:
+        raise PlanException('No temp dir has room for the temp files, and the poster does not fit in memory')
+
+    raise PlanException('Rendering needs about {:.0f}MB, more than the {:.0f}MB allowed'.format(
+        leanest / (1 - MEMORY_HEADROOM) / 1024 / 1024, max_memory / 1024 / 1024
+    ))
+
+
+def estimate_usage(metadata, targets, seconds_increment, frames_per_row, extractor, jobs, compositor, frame_store, encode_jobs, row_spacing=None, max_frames=None):
+    '''
+    Estimate peak memory as a list of (part, bytes), and the bytes of temp
+    files on disk, for rendering posters of every target at once
+    '''
+    width, height = metadata.frame_size
+    thumbnail_width = max(target_width for target_width, _ in targets)
+    thumbnail_width, thumbnail_height = core.thumbnail_size(metadata.frame_size, thumbnail_width)
+    num_frames = core.count_frames(metadata.duration, seconds_increment, max_frames)
+
+    # Pillow holds RGB images in 4 bytes a pixel
+    thumbnail_bytes = thumbnail_width * thumbnail_height * 4
+
+    memory = [('python', PYTHON_MEMORY)]
+    disk = 0
+
+    # every ffmpeg process decodes frames at full size, in 12 bits a pixel for most movies
+    frame_bytes = width * height * 3 // 2
+    ffmpeg_bytes = FFMPEG_MEMORY + frame_bytes * (FFMPEG_FRAME_BUFFERS + (os.cpu_count() or 1))
+    memory.append(('ffmpeg x{}'.format(jobs), ffmpeg_bytes * jobs))
+
+    if extractor == 'scene':
+        # the biggest scene changes are held until the whole movie has been seen
+        memory.append(('scene frames', num_frames * thumbnail_bytes))
+    elif jobs > 1:
+        # chunks are returned whole; a chunk per worker is being filled while as many wait their turn
+        num_chunks = min(num_frames, jobs * core.CHUNKS_PER_JOB)
+        memory.append(('extracted chunks', -(-num_frames // num_chunks) * min(jobs * 2, num_chunks) * thumbnail_bytes))
+
+    # each target is composited at once, then encoded one after another
+    encode_bytes = 0
+    for target_width, output_filename in targets:
+        estimate = core.estimate_poster(metadata, target_width, seconds_increment, frames_per_row, row_spacing, max_frames)
+        frame_width, frame_height = estimate['frame_size']
+        output_width, output_height = estimate['output_size']
+        row_height = frame_height + compose.row_spacing_for(frame_height, row_spacing)
+
+        if compositor == 'stream':
+            memory.append(('compose {}px'.format(target_width), output_width * row_height * 4))
+            disk += output_width * output_height * 3
+        elif compositor == 'mmap':
+            # pages of the canvas come and go; about a row of thumbnails is being written at once
+            memory.append(('compose {}px'.format(target_width), output_width * row_height * 3))
+            disk += output_width * output_height * 3
+        else:
+            frames = frame_width * frame_height * 3 * estimate['num_frames'] * store.ESTIMATE_STORE_RATIOS[frame_store]
+            memory.append(('frame store {}px'.format(target_width), int(frames) + output_width * frame_height * 3))
+
+        encode_bytes = max(encode_bytes, estimate_encode(output_width, output_height, output_filename, encode_jobs))
+
+    memory.append(('encode', encode_bytes))
+    return memory, disk
+
+
+def estimate_encode(width, height, output_filename, encode_jobs):
+    # bytes held while encoding: the bands in flight, each read and then compressed
+    ext = os.path.splitext(output_filename)[1].lower()
+
+    if ext == '.dzi':
+        # a band of rows for each level, which add up to about twice the full-size band
+        return compose.DZI_TILE_SIZE * width * 3 * 3
+
+    fmt = Image.registered_extensions().get(ext, 'PNG')
+    if fmt not in STREAMED_FORMATS:
+        # the whole poster as raw rows and as a Pillow image
+        return width * height * 7
+
+    if fmt == 'TIFF':
+        band_height = compose.TIFF_TILE_SIZE
+        width = -(-width // compose.TIFF_TILE_SIZE) * compose.TIFF_TILE_SIZE
+    else:
+        band_height = compose.ENCODE_BAND_HEIGHT
+
+    in_flight = encode_jobs * 2 if fmt in ('PNG', 'TIFF') else 1
+    return band_height * width * 3 * 2 * in_flight
+
+
+def candidate_temp_dirs(output_filenames):
+    # the system temp dir, then alongside the outputs
+    temp_dirs = [tempfile.gettempdir()]
+    for output_filename in output_filenames:
+        temp_dir = os.path.dirname(os.path.abspath(output_filename))
+        if temp_dir not in temp_dirs and os.path.isdir(temp_dir):
+            temp_dirs.append(temp_dir)
+    return temp_dirs
+
+
+def is_memory_backed(path):
+    # whether path is on a tmpfs or ramfs mount, from the longest matching mount point
+    path = os.path.realpath(path)
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+
+    fstype = None
+    longest = -1
+    for mount_point, mount_fstype in mounts:
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > longest:
+            fstype, longest = mount_fstype, len(mount_point)
+
+    return fstype in ('tmpfs', 'ramfs')
+
+
+def print_plan(plan, prntr):
+    prntr.p('Planned for {:.0f}MB: --jobs {} --encode-jobs {} --compositor {}{}'.format(
+        plan.max_memory / 1024 / 1024, plan.jobs, plan.encode_jobs, plan.compositor,
+        ' --frame-store {}'.format(plan.frame_store) if plan.compositor == 'memory' else ''
+    ))
+    for note in plan.notes:
+        prntr.p('Plan: {}'.format(note))
+
+    table = [['Part', 'Memory (MB)']]
+    for part, num_bytes in plan.memory:
+        table.append([part, '{:.1f}'.format(num_bytes / 1024 / 1024)])
+    table.append(['peak', '{:.1f}'.format(plan.peak_memory / 1024 / 1024)])
+    prntr.p(table, tabular=True)
+
+    if plan.disk:
+        prntr.p('Temp files need {:.1f}MB in {}'.format(plan.disk / 1024 / 1024, plan.temp_dir))
@@ -263,7 +263,7 @@ class CliPrinter:
             len_max_string = max(len(str(row[colindex])) for row in data)
             # calculate the number of tabs required
             num_tabs = 1
-            while len_max_string - (CliPrinter.TAB_SIZE * num_tabs) > 0:
+            while len_max_string - (CliPrinter.TAB_SIZE * num_tabs) >= 0:
                 num_tabs += 1
             # store for later
             column_tab_sizes[colindex] = num_tabs
@@ -364,6 +364,9 @@ class DummyPrinter:
     def progressf(self, *args, **kwargs):
         pass
 
+    def close(self, *args, **kwargs):
+        pass
+
 
 class IllegalArgumentError(ValueError):
     pass
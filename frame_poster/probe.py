@@ -0,0 +1,138 @@
+import fractions
+import json
+import os
+import subprocess
+import threading
+
+
+class MovieMetadata:
+    '''
+    Duration, video stream dimensions, frame rate and rotation of a movie,
+    from a single ffprobe call. The keyframe index needs a pass over every
+    packet in the file, so it is only read the first time it's used.
+    '''
+    def __init__(self, movie_filepath, duration, width, height, frame_rate, rotation=0, start_time=0.0):
+        self.movie_filepath = movie_filepath
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.frame_rate = frame_rate
+        self.rotation = rotation
+        self.start_time = start_time
+
+        self._keyframes = None
+        self._lock = threading.Lock()
+
+    @property
+    def length(self):
+        # whole seconds, for scheduling and progress
+        return int(self.duration)
+
+    @property
+    def frame_size(self):
+        # ffmpeg applies the rotation when decoding, so frames come out at display size
+        if self.rotation % 180:
+            return self.height, self.width
+        return self.width, self.height
+
+    @property
+    def keyframes(self):
+        # relative to the start of the movie, as ffmpeg's -ss and filter timestamps are
+        with self._lock:
+            if self._keyframes is None:
+                self._keyframes = [t - self.start_time for t in probe_keyframes(self.movie_filepath)]
+        return self._keyframes
+
+    def __repr__(self):
+        return '<MovieMetadata {} {}x{} {:.3f}s {:.3f}fps>'.format(
+            os.path.basename(self.movie_filepath), self.width, self.height, self.duration, self.frame_rate
+        )
+
+
+# probed metadata, keyed by movie path, size and mtime
+_probe_cache = {}
+_probe_lock = threading.Lock()
+
+
+def probe_movie(movie_filepath):
+    '''
+    Return the MovieMetadata for a movie, running ffprobe only the first
+    time a given file is seen
+    '''
+    stat = os.stat(movie_filepath)
+    key = (os.path.abspath(movie_filepath), stat.st_size, stat.st_mtime)
+
+    with _probe_lock:
+        if key not in _probe_cache:
+            _probe_cache[key] = _run_probe(movie_filepath)
+        return _probe_cache[key]
+
+
+def _run_probe(movie_filepath):
+    try:
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-print_format', 'json',
+            '-show_format', '-show_streams', '-select_streams', 'v:0', movie_filepath
+        ]).decode('utf8')
+        data = json.loads(output)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        raise Exception('Failed calling ffprobe!')
+
+    if not data.get('streams'):
+        raise Exception('No video stream found in {}'.format(movie_filepath))
+
+    stream = data['streams'][0]
+
+    # container duration, falling back to the stream's own
+    duration = data.get('format', {}).get('duration') or stream.get('duration')
+    if duration is None:
+        raise Exception('Failed reading duration of {}'.format(movie_filepath))
+
+    return MovieMetadata(
+        movie_filepath,
+        float(duration),
+        int(stream['width']),
+        int(stream['height']),
+        _parse_rate(stream.get('avg_frame_rate')) or _parse_rate(stream.get('r_frame_rate')),
+        _parse_rotation(stream),
+        float(data.get('format', {}).get('start_time') or 0),
+    )
+
+
+def _parse_rate(rate):
+    # ffprobe rates are fractions, and 0/0 when unknown
+    try:
+        return float(fractions.Fraction(rate))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def _parse_rotation(stream):
+    # newer ffprobe reports a display matrix, older ones a rotate tag
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(round(float(side_data['rotation']))) % 360
+
+    return int(stream.get('tags', {}).get('rotate', 0)) % 360
+
+
+def probe_keyframes(movie_filepath):
+    '''
+    Return a sorted list of keyframe timestamps in seconds, read from the
+    packet flags so nothing is decoded
+    '''
+    try:
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', movie_filepath
+        ]).decode('utf8')
+    except (OSError, subprocess.CalledProcessError):
+        raise Exception('Failed calling ffprobe!')
+
+    keyframes = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+
+    return sorted(keyframes)
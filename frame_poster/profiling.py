@@ -0,0 +1,127 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+
+
+class Profiler:
+    '''
+    Wall time and call counts per pipeline stage, plus named counters.
+    Stages timed on worker threads are summed, so with --jobs a stage can
+    account for more time than the run took.
+    '''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, name, iterable):
+        # time spent producing each item of an iterable, such as frames from an extractor
+        iterator = iter(iterable)
+
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, calls=0)
+                return
+
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def add(self, name, seconds, calls=1):
+        with self.lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + calls)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        return {
+            'total': time.perf_counter() - self.start,
+            'stages': dict((name, {'seconds': seconds, 'calls': calls}) for name, (seconds, calls) in self.stages.items()),
+            'counters': dict(self.counters),
+        }
+
+    def report(self, prntr):
+        # per-stage breakdown, in the order stages first ran
+        total = time.perf_counter() - self.start
+
+        table = [['Stage', 'Time', 'Calls', 'Share']]
+        for name, (seconds, calls) in self.stages.items():
+            table.append([name, '{:.3f}s'.format(seconds), str(calls), '{:.0%}'.format(seconds / total)])
+        table.append(['total', '{:.3f}s'.format(total), '', ''])
+        prntr.p(table, tabular=True)
+
+        if self.counters:
+            prntr.p([['Counter', 'Value']] + [[name, str(value)] for name, value in self.counters.items()], tabular=True)
+
+    def dump_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class NullProfiler:
+    def stage(self, *args, **kwargs):
+        return contextlib.nullcontext()
+
+    def timed(self, name, iterable):
+        return iterable
+
+    def add(self, *args, **kwargs):
+        pass
+
+    def count(self, *args, **kwargs):
+        pass
+
+
+@contextlib.contextmanager
+def cprofile(filename):
+    '''
+    Run the body under cProfile, writing stats readable by pstats or snakeviz
+    to filename. Before Python 3.12 a profiler only sees the thread that
+    enabled it, so every thread started meanwhile, such as the --jobs and
+    --batch workers, gets a profiler of its own, and their stats are merged.
+    '''
+    profiles = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def profile_thread(frame, event, arg):
+        # the first event on a new thread replaces this hook with the thread's own profiler
+        profile = cProfile.Profile()
+        with lock:
+            profiles.append(profile)
+        profile.enable()
+
+    per_thread = sys.version_info < (3, 12)
+    if per_thread:
+        threading.setprofile(profile_thread)
+
+    profiles[0].enable()
+    try:
+        yield profiles[0]
+    finally:
+        profiles[0].disable()
+        if per_thread:
+            threading.setprofile(None)
+
+        stats = pstats.Stats(profiles[0])
+        with lock:
+            for profile in profiles[1:]:
+                stats.add(profile)
+        stats.dump_stats(filename)
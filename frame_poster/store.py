@@ -0,0 +1,109 @@
+import array
+import io
+import zlib
+
+import numpy
+from PIL import Image
+
+FRAME_STORE = 'deflate'
+FRAME_STORE_CODECS = ('raw', 'deflate', 'jpeg')
+
+# deflate is kept fast; pixels are differenced against their left neighbour first, as a PNG Sub filter
+STORE_COMPRESS_LEVEL = 1
+STORE_JPEG_QUALITY = 90
+
+# rough sizes of stored frames against raw RGB, for planning memory
+ESTIMATE_STORE_RATIOS = {
+    'raw': 1.0,
+    'deflate': 0.5,
+    'jpeg': 0.1,
+}
+
+
+class FrameStore:
+    '''
+    Thumbnails packed end to end in one growing buffer, each either raw RGB,
+    losslessly deflated, or JPEG encoded, and decoded again only when it's
+    read. Offsets and sizes are kept in flat arrays, so each frame costs a
+    few bytes of bookkeeping on top of its encoded pixels.
+    '''
+    def __init__(self, codec=FRAME_STORE, expected_frames=None):
+        if codec not in FRAME_STORE_CODECS:
+            raise Exception('Unknown frame store {}'.format(codec))
+
+        self.codec = codec
+        self.expected_frames = expected_frames
+
+        self.buf = bytearray()
+        self.used = 0
+        self.offsets = array.array('Q', [0])
+        self.sizes = array.array('I')
+
+    def __len__(self):
+        return len(self.sizes) // 2
+
+    @property
+    def nbytes(self):
+        return self.used
+
+    def add(self, im):
+        pixels = numpy.asarray(im.convert('RGB'))
+        data = self._encode(pixels)
+
+        if self.codec == 'raw' and self.expected_frames and not self.buf:
+            # raw frames are all one size, so with a frame count the buffer is allocated once
+            self.buf = bytearray(len(data) * self.expected_frames)
+
+        # past the end of the buffer this appends, and bytearray grows by an eighth at a time
+        self.buf[self.used:self.used + len(data)] = data
+        self.used += len(data)
+        self.offsets.append(self.used)
+        self.sizes.extend((pixels.shape[1], pixels.shape[0]))
+
+    def get(self, index):
+        # the frame at index as a (height, width, 3) uint8 array
+        width, height = self.sizes[index * 2], self.sizes[index * 2 + 1]
+        data = memoryview(self.buf)[self.offsets[index]:self.offsets[index + 1]]
+
+        if self.codec == 'raw':
+            # copied, so no view into the buffer outlives a read
+            return numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width, 3).copy()
+
+        if self.codec == 'jpeg':
+            return numpy.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+
+        # undo the left-neighbour differencing; uint8 sums wrap just as the differences did
+        deltas = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8).reshape(height, width, 3)
+        return numpy.cumsum(deltas, axis=1, dtype=numpy.uint8)
+
+    def get_range(self, start, stop):
+        '''
+        Raw frames start to stop as one (count, height, width, 3) uint8 array
+        viewing the buffer, without a copy, or None unless the store is raw
+        and the frames are all one size. The view must be let go before the
+        next add, which may move the buffer.
+        '''
+        sizes = set(zip(self.sizes[start * 2:stop * 2:2], self.sizes[start * 2 + 1:stop * 2:2]))
+        if self.codec != 'raw' or len(sizes) != 1:
+            return None
+
+        width, height = sizes.pop()
+        data = memoryview(self.buf)[self.offsets[start]:self.offsets[stop]]
+        return numpy.frombuffer(data, dtype=numpy.uint8).reshape(stop - start, height, width, 3)
+
+    def close(self):
+        self.buf = bytearray()
+        self.used = 0
+
+    def _encode(self, pixels):
+        if self.codec == 'raw':
+            return pixels.tobytes()
+
+        if self.codec == 'jpeg':
+            f = io.BytesIO()
+            Image.fromarray(pixels).save(f, format='JPEG', quality=STORE_JPEG_QUALITY)
+            return f.getvalue()
+
+        deltas = pixels.copy()
+        deltas[:, 1:] -= pixels[:, :-1]
+        return zlib.compress(deltas.tobytes(), STORE_COMPRESS_LEVEL)
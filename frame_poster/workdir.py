@@ -0,0 +1,182 @@
+import json
+import os
+
+from PIL import Image
+
+# frames between each fsync of the strip to disk
+CHECKPOINT_INTERVAL = 10
+
+MANIFEST_FILENAME = 'manifest.json'
+FRAMES_FILENAME = 'frames.raw'
+TIMESTAMPS_FILENAME = 'timestamps.txt'
+
+
+class WorkDirException(Exception):
+    pass
+
+
+class FrameStrip:
+    '''
+    Extracted thumbnails kept in a work directory, so an interrupted render
+    can be resumed. Frames are appended to one raw RGB file and their
+    timestamps to a text file alongside; a JSON manifest records the movie
+    and the settings the frames were extracted with.
+    '''
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.manifest = None
+        self.num_frames = 0
+
+        self.frames_file = self.timestamps_file = None
+
+    @property
+    def frame_size(self):
+        return tuple(self.manifest['frame_size']) if self.manifest['frame_size'] else None
+
+    @property
+    def complete(self):
+        return self.manifest['complete']
+
+    def start(self, params):
+        # begin a new strip, discarding anything already in the work directory
+        if not os.path.isdir(self.work_dir):
+            os.makedirs(self.work_dir)
+
+        self.manifest = dict(params, frame_size=None, complete=False)
+        self.num_frames = 0
+        self._write_manifest()
+
+        self._open('w+b', 'w')
+
+    def resume(self, params):
+        '''
+        Reopen a strip left by an earlier run with the same params, dropping
+        any frame which was only partly written when it was interrupted
+        '''
+        manifest = self.load()
+
+        for key, value in params.items():
+            if manifest.get(key) != value:
+                raise WorkDirException(
+                    'Work dir {} was made with a different {}; run without --resume to start again'.format(self.work_dir, key)
+                )
+
+        # only frames with both pixels and a timestamp on disk count
+        timestamps = self._read_timestamps()
+        if self.frame_size:
+            frame_bytes = self.frame_size[0] * self.frame_size[1] * 3
+            self.num_frames = min(len(timestamps), os.path.getsize(self._path(FRAMES_FILENAME)) // frame_bytes)
+        else:
+            frame_bytes = self.num_frames = 0
+
+        self._open('r+b', 'r+')
+        self.frames_file.truncate(self.num_frames * frame_bytes)
+        self.frames_file.seek(0, os.SEEK_END)
+
+        self.timestamps_file.seek(0)
+        self.timestamps_file.truncate(0)
+        self.timestamps_file.writelines('{}\n'.format(seconds) for seconds in timestamps[:self.num_frames])
+        self.timestamps_file.flush()
+
+        return timestamps[:self.num_frames]
+
+    def load(self):
+        # read the manifest of an existing strip
+        try:
+            with open(self._path(MANIFEST_FILENAME)) as f:
+                self.manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            raise WorkDirException('No frames found in {}'.format(self.work_dir))
+
+        self.num_frames = len(self._read_timestamps())
+        return self.manifest
+
+    def append(self, seconds, im):
+        if self.frame_size is None:
+            # the first frame decides the size of every frame in the strip
+            self.manifest['frame_size'] = list(im.size)
+            self._write_manifest()
+        elif im.size != self.frame_size:
+            im = im.resize(self.frame_size)
+
+        # pixels first, so a timestamp is never written for a partial frame
+        self.frames_file.write(im.convert('RGB').tobytes())
+        self.frames_file.flush()
+        self.timestamps_file.write('{}\n'.format(seconds))
+        self.timestamps_file.flush()
+        self.num_frames += 1
+
+        if self.num_frames % CHECKPOINT_INTERVAL == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # flush to the disk itself, to survive the machine going away as well as the process
+        os.fsync(self.frames_file.fileno())
+        os.fsync(self.timestamps_file.fileno())
+
+    def finish(self):
+        self.checkpoint()
+        self.manifest['complete'] = True
+        self._write_manifest()
+
+    def frames(self):
+        # yield (seconds, image) for each frame in the strip
+        timestamps = self._read_timestamps()[:self.num_frames]
+        if not timestamps:
+            return
+
+        frame_bytes = self.frame_size[0] * self.frame_size[1] * 3
+
+        with open(self._path(FRAMES_FILENAME), 'rb') as f:
+            for seconds in timestamps:
+                yield seconds, Image.frombytes('RGB', self.frame_size, f.read(frame_bytes))
+
+    def close(self):
+        for f in (self.frames_file, self.timestamps_file):
+            if f is not None:
+                f.close()
+
+    def _open(self, frames_mode, timestamps_mode):
+        self.frames_file = open(self._path(FRAMES_FILENAME), frames_mode)
+        self.timestamps_file = open(self._path(TIMESTAMPS_FILENAME), timestamps_mode)
+
+    def _read_timestamps(self):
+        try:
+            with open(self._path(TIMESTAMPS_FILENAME)) as f:
+                lines = f.read().split('\n')
+        except (IOError, OSError):
+            return []
+
+        # the last line is only complete if it ends with a newline
+        return [json.loads(line) for line in lines[:-1]]
+
+    def _write_manifest(self):
+        # write alongside and rename, so the manifest is never left half written
+        with open(self._path(MANIFEST_FILENAME + '.tmp'), 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.rename(self._path(MANIFEST_FILENAME + '.tmp'), self._path(MANIFEST_FILENAME))
+
+    def _path(self, filename):
+        return os.path.join(self.work_dir, filename)
+
+
+def checkpointed_frames(strip, seconds_increment, extract):
+    '''
+    Yield (seconds, thumbnail) for the frames already in the strip, then
+    call extract(start) to decode the rest of the movie from the following
+    timestamp, appending each new thumbnail to the strip as it arrives
+    '''
+    start = 0
+
+    for seconds, im in strip.frames():
+        yield seconds, im
+        start = seconds + seconds_increment
+
+    if strip.complete:
+        return
+
+    for seconds, im in extract(start):
+        strip.append(seconds, im)
+        yield seconds, im
+
+    strip.finish()
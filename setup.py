@@ -22,14 +22,12 @@ requires = [
     open('requirements.txt').read()
 ]
 
-if sys.version_info < (2, 7):
-    requires += ['argparse']
-
 setup(
     name='frame-poster',
     version=frame_poster.__version__,
     description='',
-    long_description=open('README.rst').read(),
+    long_description=open('README.md').read(),
+    long_description_content_type='text/markdown',
     author='Matt Black',
     author_email='dev@mafro.net',
     url='http://github.com/mafrosis/frame-poster',
@@ -38,6 +36,7 @@ setup(
     package_dir={'': '.'},
     include_package_data=True,
     install_requires=requires,
+    python_requires='>=3.7',
     scripts=['scripts/frame-poster'],
     license=open('LICENSE').read(),
     classifiers=(
@@ -48,7 +47,13 @@ setup(
         'Natural Language :: English',
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ),
 )
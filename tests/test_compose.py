@@ -0,0 +1,228 @@
+import math
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+from PIL import Image
+
+from frame_poster import compose
+
+SIZES = [(1, 1), (1, 777), (1000, 1), (257, 255), (1000, 777)]
+COMPRESS_LEVELS = (0, 1, 3, 9)
+ENCODE_JOBS = (1, 4)
+
+
+class ArraySource:
+    # a row source over a (height, width, 3) array, like the canvases save_rows reads
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.height, self.width = pixels.shape[:2]
+
+    def read_rows(self, y, num_rows):
+        return self.pixels[y:y + num_rows].tobytes()
+
+
+def make_pixels(width, height):
+    # a gradient with noise on top, so there is both something to predict and something to compress
+    rng = numpy.random.default_rng(width * 1000 + height)
+    y, x = numpy.mgrid[:height, :width]
+    pixels = numpy.stack([x % 256, y % 256, (x + y) % 256], axis=-1)
+    return (pixels + rng.integers(0, 16, pixels.shape)).astype(numpy.uint8)
+
+
+class TestWriteRows(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def save(self, pixels, ext, **kwargs):
+        filename = os.path.join(self.tmpdir.name, 'poster{}'.format(ext))
+        compose.save_rows(ArraySource(pixels), filename, **kwargs)
+        return filename
+
+    def assertRoundTrip(self, filename, pixels):
+        with Image.open(filename) as im:
+            self.assertEqual(im.size, (pixels.shape[1], pixels.shape[0]))
+            numpy.testing.assert_array_equal(numpy.asarray(im.convert('RGB')), pixels)
+
+    def test_png_and_tiff(self):
+        for width, height in SIZES:
+            pixels = make_pixels(width, height)
+            for ext in ('.png', '.tif'):
+                for compress_level in COMPRESS_LEVELS:
+                    for jobs in ENCODE_JOBS:
+                        with self.subTest(ext=ext, size=(width, height), compress_level=compress_level, jobs=jobs):
+                            filename = self.save(pixels, ext, compress_level=compress_level, jobs=jobs)
+                            self.assertRoundTrip(filename, pixels)
+
+    def test_bmp_and_ppm(self):
+        for width, height in SIZES:
+            pixels = make_pixels(width, height)
+            for ext in ('.bmp', '.ppm'):
+                with self.subTest(ext=ext, size=(width, height)):
+                    filename = self.save(pixels, ext)
+                    self.assertRoundTrip(filename, pixels)
+
+                    # both are uncompressed, so their size is known exactly
+                    fmt = Image.registered_extensions()[ext]
+                    expected = dict((f, size) for f, size, _ in compose.estimate_file_sizes(width, height))[fmt]
+                    self.assertEqual(os.path.getsize(filename), expected)
+
+    def test_bigtiff(self):
+        # any poster is too big for a classic TIFF when the limit is zero
+        with mock.patch.object(compose, 'TIFF_MAX_CLASSIC_SIZE', 0):
+            for width, height in [(1, 1), (1000, 777)]:
+                pixels = make_pixels(width, height)
+                for compress_level in (0, 3):
+                    for jobs in ENCODE_JOBS:
+                        with self.subTest(size=(width, height), compress_level=compress_level, jobs=jobs):
+                            filename = self.save(pixels, '.tif', compress_level=compress_level, jobs=jobs)
+
+                            with open(filename, 'rb') as f:
+                                self.assertEqual(f.read(4), b'II+\x00')
+                            self.assertRoundTrip(filename, pixels)
+
+    def test_unknown_suffix(self):
+        with self.assertRaises(KeyError):
+            self.save(make_pixels(2, 2), '.xyz')
+
+
+class TestCompositors(unittest.TestCase):
+    def layout(self, compositor, thumbnails, frames_per_row=4, thumbnail_width=24, **kwargs):
+        # the poster laid out by compositor, as a (height, width, 3) array
+        if compositor == 'stream':
+            canvas = compose.RowSpool(thumbnail_width * frames_per_row)
+            rows = compose.RowCompositor(canvas, frames_per_row, thumbnail_width, row_spacing=kwargs.get('row_spacing'))
+        else:
+            canvas = compose.ArrayCanvas(thumbnail_width * frames_per_row)
+            rows = compose.ArrayCompositor(canvas, frames_per_row, thumbnail_width, **kwargs)
+
+        for im in thumbnails:
+            rows.add(im)
+        rows.close()
+
+        try:
+            # read in bands which don't line up with the rows of thumbnails
+            pixels = b''.join(canvas.read_rows(y, min(7, canvas.height - y)) for y in range(0, canvas.height, 7))
+            return numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(canvas.height, canvas.width, 3)
+        finally:
+            canvas.close()
+
+    def test_memory_matches_stream(self):
+        # every thumbnail different, so one put in the wrong cell shows
+        rng = numpy.random.default_rng(0)
+
+        for num_frames in (1, 4, 9, 12):
+            for row_spacing in (None, 0, 5):
+                thumbnails = [
+                    Image.fromarray(rng.integers(0, 256, (13, 24, 3), dtype=numpy.uint8)) for _ in range(num_frames)
+                ]
+                expected = self.layout('stream', thumbnails, row_spacing=row_spacing)
+
+                for frame_store in ('raw', 'deflate'):
+                    for expected_frames in (None, num_frames):
+                        with self.subTest(
+                            num_frames=num_frames, row_spacing=row_spacing, frame_store=frame_store,
+                            expected_frames=expected_frames
+                        ):
+                            pixels = self.layout(
+                                'memory', thumbnails, row_spacing=row_spacing, frame_store=frame_store,
+                                expected_frames=expected_frames
+                            )
+                            numpy.testing.assert_array_equal(pixels, expected)
+
+    def test_narrow_thumbnails(self):
+        # thumbnails narrower than the column are padded with black, as the stream compositor does
+        thumbnails = [Image.fromarray(make_pixels(20, 13)) for _ in range(6)]
+        expected = self.layout('stream', thumbnails)
+
+        for frame_store in ('raw', 'deflate'):
+            with self.subTest(frame_store=frame_store):
+                numpy.testing.assert_array_equal(self.layout('memory', thumbnails, frame_store=frame_store), expected)
+
+    def test_jpeg_store(self):
+        y, x = numpy.mgrid[:13, :24]
+        thumbnails = [
+            Image.fromarray(numpy.stack([x * 10, y * 18, numpy.full_like(x, 40 * i)], axis=-1).astype(numpy.uint8))
+            for i in range(6)
+        ]
+        expected = self.layout('stream', thumbnails)
+        pixels = self.layout('memory', thumbnails, frame_store='jpeg')
+
+        self.assertEqual(pixels.shape, expected.shape)
+        self.assertLess(numpy.abs(pixels.astype(int) - expected).mean(), 4)
+
+
+class TestWriteDzi(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, pixels, tile_size, tile_format, jobs):
+        filename = os.path.join(self.tmpdir.name, 'poster.dzi')
+        compose.write_dzi(ArraySource(pixels), filename, tile_size=tile_size, tile_format=tile_format, jobs=jobs)
+        return filename
+
+    def read_level(self, filename, level, tile_format):
+        # the tiles of one level stitched back together
+        level_dir = os.path.join('{}_files'.format(os.path.splitext(filename)[0]), str(level))
+        names = os.listdir(level_dir)
+        columns = 1 + max(int(name.split('_')[0]) for name in names)
+        rows = 1 + max(int(name.split('_')[1].split('.')[0]) for name in names)
+        self.assertEqual(len(names), columns * rows)
+
+        return numpy.concatenate([
+            numpy.concatenate([
+                numpy.asarray(Image.open(os.path.join(level_dir, '{}_{}.{}'.format(column, row, tile_format))).convert('RGB'))
+                for column in range(columns)
+            ], axis=1)
+            for row in range(rows)
+        ])
+
+    def test_levels(self):
+        for width, height in SIZES:
+            pixels = make_pixels(width, height)
+            for jobs in ENCODE_JOBS:
+                with self.subTest(size=(width, height), jobs=jobs):
+                    filename = self.write(pixels, 256, 'png', jobs)
+
+                    with open(filename) as f:
+                        descriptor = f.read()
+                    self.assertIn('<Size Width="{}" Height="{}"/>'.format(width, height), descriptor)
+                    self.assertIn('TileSize="256"', descriptor)
+
+                    # each level halves the one above, down to a single pixel
+                    num_levels = math.ceil(math.log2(max(width, height))) + 1
+                    self.assertEqual(len(os.listdir(os.path.splitext(filename)[0] + '_files')), num_levels)
+
+                    for level in range(num_levels):
+                        scale = 2 ** (num_levels - 1 - level)
+                        level_pixels = self.read_level(filename, level, 'png')
+                        self.assertEqual(level_pixels.shape[:2], (-(-height // scale), -(-width // scale)))
+
+                    # the top level is the poster itself, losslessly with PNG tiles
+                    numpy.testing.assert_array_equal(self.read_level(filename, num_levels - 1, 'png'), pixels)
+
+    def test_jpeg_tiles(self):
+        # a smooth gradient, which JPEG keeps close to the original
+        y, x = numpy.mgrid[:777, :1000]
+        pixels = numpy.stack([x * 255 // 999, y * 255 // 776, numpy.full_like(x, 128)], axis=-1).astype(numpy.uint8)
+        filename = self.write(pixels, compose.DZI_TILE_SIZE, compose.DZI_TILE_FORMAT, 4)
+
+        top = self.read_level(filename, 10, compose.DZI_TILE_FORMAT)
+        self.assertEqual(top.shape, pixels.shape)
+        self.assertLess(numpy.abs(top.astype(int) - pixels).mean(), 2)
+
+    def test_replaces_previous_tiles(self):
+        filename = self.write(make_pixels(1000, 777), 256, 'png', 1)
+        filename = self.write(make_pixels(10, 10), 256, 'png', 1)
+
+        tiles_dir = os.path.splitext(filename)[0] + '_files'
+        self.assertEqual(len(os.listdir(tiles_dir)), 5)
+        self.assertFalse(os.path.exists(tiles_dir + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
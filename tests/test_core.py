@@ -0,0 +1,67 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import numpy
+
+from frame_poster import core, probe
+
+
+@unittest.skipUnless(shutil.which('ffmpeg') and shutil.which('ffprobe'), 'needs ffmpeg and ffprobe')
+class TestKeyframeExtractor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+
+        # a keyframe every 9.5s, so timestamps on a 10s grid snap to keyframes before them
+        cls.movie = os.path.join(cls.tmpdir, 'movie.mp4')
+        subprocess.check_call([
+            'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=160x90:rate=24:duration=60',
+            '-c:v', 'libx264', '-g', '228', '-keyint_min', '228', '-sc_threshold', '0', '-pix_fmt', 'yuv420p',
+            cls.movie,
+        ])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def extract(self, **kwargs):
+        return [
+            (seconds, numpy.asarray(im))
+            for seconds, im in core.extract_frames_keyframe(self.movie, self.tmpdir, 10, **kwargs)
+        ]
+
+    def assertSameFrames(self, frames, expected):
+        self.assertEqual([seconds for seconds, _ in frames], [seconds for seconds, _ in expected])
+        for (seconds, pixels), (_, expected_pixels) in zip(frames, expected):
+            numpy.testing.assert_array_equal(pixels, expected_pixels, err_msg='frame at {}s'.format(seconds))
+
+    def test_snaps_to_keyframes(self):
+        self.assertEqual(probe.probe_movie(self.movie).keyframes[:3], [0.0, 9.5, 19.0])
+
+        frames = self.extract()
+        self.assertEqual([seconds for seconds, _ in frames], [0, 10, 20, 30, 40, 50])
+
+        # each timestamp got its own keyframe
+        for (_, a), (_, b) in zip(frames, frames[1:]):
+            self.assertFalse((a == b).all())
+
+    def test_start_after_keyframe(self):
+        # 10s snaps to the keyframe at 9.5s, before the chunk starts
+        frames = self.extract()
+        self.assertSameFrames(self.extract(start=10, end=30), frames[1:3])
+
+    def test_chunks(self):
+        frames = self.extract()
+
+        chunk_tmpdir = tempfile.mkdtemp(dir=self.tmpdir)
+        chunks = list(core.extract_frames_parallel(
+            core.extract_frames_keyframe, self.movie, chunk_tmpdir, 10, 60, 3
+        ))
+        self.assertSameFrames([(seconds, numpy.asarray(im)) for seconds, im in chunks], frames)
+
+
+if __name__ == '__main__':
+    unittest.main()
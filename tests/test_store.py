@@ -0,0 +1,66 @@
+import unittest
+
+import numpy
+from PIL import Image
+
+from frame_poster import store
+
+
+def make_frames(num_frames, width=24, height=13):
+    rng = numpy.random.default_rng(num_frames)
+    return [rng.integers(0, 256, (height, width, 3), dtype=numpy.uint8) for _ in range(num_frames)]
+
+
+class TestFrameStore(unittest.TestCase):
+    def test_lossless(self):
+        frames = make_frames(5) + make_frames(2, width=7, height=3)
+
+        for codec in ('raw', 'deflate'):
+            for expected_frames in (None, 5, 20):
+                with self.subTest(codec=codec, expected_frames=expected_frames):
+                    frame_store = store.FrameStore(codec, expected_frames)
+                    for frame in frames:
+                        frame_store.add(Image.fromarray(frame))
+
+                    self.assertEqual(len(frame_store), len(frames))
+                    for i, frame in enumerate(frames):
+                        numpy.testing.assert_array_equal(frame_store.get(i), frame)
+
+    def test_jpeg(self):
+        y, x = numpy.mgrid[:13, :24]
+        frame = numpy.stack([x * 10, y * 18, numpy.full_like(x, 128)], axis=-1).astype(numpy.uint8)
+
+        frame_store = store.FrameStore('jpeg')
+        frame_store.add(Image.fromarray(frame))
+
+        self.assertEqual(frame_store.get(0).shape, frame.shape)
+        self.assertLess(numpy.abs(frame_store.get(0).astype(int) - frame).mean(), 4)
+
+    def test_get_range(self):
+        frames = make_frames(5)
+
+        frame_store = store.FrameStore('raw', 5)
+        for frame in frames:
+            frame_store.add(Image.fromarray(frame))
+
+        numpy.testing.assert_array_equal(frame_store.get_range(1, 4), numpy.stack(frames[1:4]))
+        self.assertEqual(frame_store.nbytes, sum(frame.nbytes for frame in frames))
+
+    def test_get_range_needs_raw_frames_of_one_size(self):
+        deflated = store.FrameStore('deflate')
+        mixed = store.FrameStore('raw')
+        for frame in make_frames(2) + make_frames(1, width=7, height=3):
+            deflated.add(Image.fromarray(frame))
+            mixed.add(Image.fromarray(frame))
+
+        self.assertIsNone(deflated.get_range(0, 2))
+        self.assertIsNone(mixed.get_range(1, 3))
+        self.assertEqual(mixed.get_range(0, 2).shape, (2, 13, 24, 3))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(Exception):
+            store.FrameStore('gif')
+
+
+if __name__ == '__main__':
+    unittest.main()